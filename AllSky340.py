@@ -9,8 +9,14 @@ easily be adapted to that as well.  The information used here was gleaned from:
 
 http://sbig.impulse.net/pdffiles/SBIG%20SG-4%20&%20AllSky-340(C)%20Serial%20Interface%20Specification.pdf
 
-Currently only supporting 1x1 binning and either full (640x480) or cropped
-(512x480).
+Supports 1x1 binning with either full (640x480) or cropped (512x480) frames,
+2x2 binning (320x240) and square sub-frames of up to 127x127 pixels.
+
+The port can also be a pyserial URL like rfc2217://host:port or
+socket://host:port for a camera on the other end of a network (see
+Doc/examples/rfc2217_server.py and tcp_serial_redirect.py).  Block
+acknowledgements are then pipelined so image transfers don't pay a network
+round trip per block.
 
 Author                     Version             Date
 --------------------------------------------------------
@@ -21,8 +27,6 @@ TODO
 - add support for SG-4 and color version.  split into basic class for SG-4
   that the AllSky340 classes can inherit from.
 
-- figure out how to do simultaneous expose and readout...
-
 Updates
 --------------------------------------------------------
 
@@ -30,58 +34,234 @@ Updates
 
 
 import sys
-import os
+import math
 import serial
 import struct
-from astropy.io import fits as pyfits
 import time
-import numpy as np
-import logging
-
-
-def emit_colored_ansi(fn):
-    def new(*args):
-        levelno = args[1].levelno
-        if(levelno >= 50):
-            color = '\x1b[31m'  # red
-        elif(levelno >= 40):
-            color = '\x1b[31m'  # red
-        elif(levelno >= 30):
-            color = '\x1b[33m'  # yellow
-        elif(levelno >= 20):
-            color = '\x1b[32m'  # green
-        elif(levelno >= 10):
-            color = '\x1b[35m'  # pink
+from collections import namedtuple, deque
+
+from bufserial import BufferedSerial
+from camstats import Stats, dump_json
+from camlog import cam_log, setup_logging, RateLimited
+from lazyimport import lazy_import
+
+# numpy is only needed once there are pixels to deal with.  commands like
+# ping and firmware shouldn't have to wait for it to load.
+np = lazy_import("numpy")
+
+
+# baudrates the camera supports and the commands to switch to them
+BAUDRATES = {9600:   "B0",
+             19200:  "B1",
+             38400:  "B2",
+             57600:  "B3",
+             115200: "B4",
+             230400: "B5",
+             460800: "B6"}
+
+# each command byte is inverted and xor'ed into the checksum with the most
+# significant bit always cleared.  since xor is associative we can just look up
+# the inverted/masked value of each byte and xor those together.
+CHECKSUM_TABLE = [~i & 0x7F for i in range(256)]
+
+
+def checksum(c):
+    """
+    checksum that must follow every command sent to the camera
+    """
+    cs = 0
+    for ch in c:
+        cs ^= CHECKSUM_TABLE[ord(ch)]
+    return cs
+
+# the fixed commands we send over and over (especially the per-block K/R
+# acknowledgements) are framed with their checksums once up front.
+FRAMED_COMMANDS = dict((c, c + struct.pack("B", checksum(c))) for c in
+                       ["E", "O", "C", "K", "A", "V", "X", "R", "S", "k",
+                        "B0", "B1", "B2", "B3", "B4", "B5", "B6", "Test"])
+
+
+def block_lrc(block):
+    """
+    XOR of all the bytes in a block of pixels, i.e. the check byte the camera
+    sends after each block.  block can be a string/bytearray or a uint8 numpy
+    view.  the bulk of the block is XOR'ed 8 bytes at a time and the result
+    folded back down to a single byte.
+    """
+    if not isinstance(block, np.ndarray):
+        block = np.frombuffer(block, dtype=np.uint8)
+    n = len(block)
+    nwords = n // 8
+    lrc = 0
+    if nwords:
+        words = block[:nwords * 8].view(np.uint64)
+        lrc = int(np.bitwise_xor.reduce(words))
+        lrc ^= lrc >> 32
+        lrc ^= lrc >> 16
+        lrc ^= lrc >> 8
+        lrc &= 0xFF
+    if n > nwords * 8:
+        lrc ^= int(np.bitwise_xor.reduce(block[nwords * 8:]))
+    return lrc
+
+
+# readout geometry for each mode: rows, columns, and the number of pixels the
+# camera sends per block.  sub-frames are square and sent one line per block
+# so their geometry depends on the size set with set_subframe().
+READOUT_MODES = {"full": (480, 640, 4096),
+                 "cropped": (480, 512, 4096),
+                 "bin2x2": (240, 320, 1024)}
+
+# readout mode byte of the T command for each mode
+MODE_BYTES = {"full": 0x00,
+              "cropped": 0x01,
+              "bin2x2": 0x02,
+              "subframe": 0xff}
+
+
+def readout_mode(mode=None, cropped=False):
+    """
+    name of the readout mode for the mode and cropped arguments taken by
+    getImage() and friends.  mode wins if it's given, otherwise cropped picks
+    between "cropped" and "full".
+    """
+    if mode is None:
+        if cropped:
+            mode = "cropped"
         else:
-            color = '\x1b[0m'  # normal
-        args[1].levelname = color + args[1].levelname + '\x1b[0m'  # normal
-        return fn(*args)
-    return new
-
-# Initialize logger
-logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
-cam_log = logging.getLogger()
-fh = logging.FileHandler("%s/skycam.log" % os.environ['HOME'])
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(logging.Formatter("%(asctime)s: %(levelname)s - %(message)s"))
-cam_log.addHandler(fh)
-ch = logging.StreamHandler()
-f = logging.Formatter("%(levelname)s: %(message)s")
-ch.setFormatter(f)
-logging.StreamHandler.emit = emit_colored_ansi(logging.StreamHandler.emit)
+            mode = "full"
+    if mode not in MODE_BYTES:
+        raise ValueError("Unknown readout mode %s" % mode)
+    return mode
+
+
+def readout_geometry(mode, subframe=None):
+    """
+    rows, columns and pixels per block for a readout mode.  True and False
+    are taken to mean cropped and full.  subframe is the (x, y, size) of the
+    sub-frame, needed for the "subframe" mode.
+    """
+    if mode is True or mode is False:
+        mode = readout_mode(cropped=mode)
+    if mode == "subframe":
+        size = subframe[2]
+        return size, size, size
+    return READOUT_MODES[mode]
+
+# what readout() yields for each block of pixels as it arrives.  progress is
+# the fraction of the frame transferred so far and rate the bytes per second
+# of good pixel data since the transfer started.
+Block = namedtuple("Block", ["index", "nblocks", "valid", "image", "rows",
+                             "pixels", "progress", "elapsed", "rate"])
+
+
+# what sequence() yields for each exposure.  timestamp is when the exposure
+# was started.
+Frame = namedtuple("Frame", ["image", "valid", "exptime", "light", "cropped",
+                             "timestamp", "mode"])
 
 
 class AllSky340:
     def __init__(self, port="/dev/tty.usbserial",
-                 baudrate=460800, timeout=0.5):
-        self.ser = serial.Serial()
-        self.ser.port = port
-        self.ser.baudrate = baudrate
-        self.ser.timeout = timeout
+                 baudrate=460800, timeout=0.5, max_retries=5,
+                 retry_backoff=0.0, backoff_factor=2.0, second_pass=True,
+                 auto_baud=False, min_baud=115200, scheduled_wait=False,
+                 wake_margin=0.5, stats_file=None, pipeline=None,
+                 max_window=16):
+        """
+        max_retries is how many times a block with a bad LRC is re-requested
+        before it's given up on.  retry_backoff is the pause (in seconds)
+        before the first re-request, multiplied by backoff_factor for each
+        one after that.  with second_pass set, blocks that still failed are
+        fetched again by re-transferring the image at the end of the readout.
+
+        with auto_baud set, the camera is found at whatever rate it's on, the
+        rates from min_baud up are tried out and the fastest one that works
+        is used.  after that the rate is stepped down or back up between
+        frames depending on how many blocks need re-sending.  see
+        adapt_baudrate().
+
+        with scheduled_wait set, wait_exposure() sleeps until wake_margin
+        seconds before the exposure is expected to be done instead of
+        reading the port the whole time.  see wait_exposure().
+
+        self.stats counts and times what goes on over the link: command
+        round trips, blocks, LRC failures, retransmits, exposure waits and
+        so on.  report() puts it together with the transport's counters and
+        a summary of the last frame, and if stats_file is given that's
+        written there as JSON after every frame.
+
+        port can be a pyserial URL (rfc2217://host:port, socket://host:port)
+        for a remote camera.  with pipeline set, which is the default for
+        URLs, the round trip to the camera is measured when it's opened and
+        readout() sends block acks ahead of the blocks so up to max_window
+        are in flight.  see ack_window().
+        """
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.backoff_factor = backoff_factor
+        self.second_pass = second_pass
+        self.auto_baud = auto_baud
+        self.min_baud = min_baud
+        # rates that passed the Test handshake, and a running average of the
+        # fraction of block transfers that had to be re-sent at each rate.
+        self.usable_bauds = sorted(BAUDRATES)
+        self.link_errors = {}
+        self.retransmits = 0
+        self.scheduled_wait = scheduled_wait
+        self.wake_margin = wake_margin
+        # when the last exposure was started and how long it was, and a
+        # running estimate of how long after the end of an exposure the
+        # camera says it's done.  exposure_timing keeps (exptime, overhead,
+        # lateness) for recent exposures, where lateness is how much later
+        # than expected the 'D' turned up.
+        self.exposure_start = None
+        self.exposure_time = 0.0
+        self.overhead = 0.0
+        self.exposure_timing = deque(maxlen=200)
+        self.stats = Stats()
+        self.stats_file = stats_file
+        # retransmit warnings come in bursts when the link is bad.  one a
+        # second is plenty.
+        self.retry_log = RateLimited(cam_log, interval=1.0)
+        self.last_frame = {}
+        setup_logging()
+        remote = "://" in port
+        if pipeline is None:
+            pipeline = remote
+        self.pipeline = pipeline
+        self.max_window = max_window
+        # round trip time to the camera, less the time on the wire
+        self.rtt = 0.0
+        self.last_window = 1
+        if remote:
+            ser = serial.serial_for_url(port, do_not_open=True)
+        else:
+            ser = serial.Serial()
+            ser.port = port
+        ser.baudrate = baudrate
+        ser.timeout = timeout
+        # everything is read through a buffer so the many small reads the
+        # protocol needs don't each turn into a read from the port.
+        # self.ser.stats() has the syscall and byte counts.
+        self.ser = BufferedSerial(ser)
+        # frame buffers, one per readout size, allocated on first use and
+        # then reused for every exposure in that mode.
+        self.frames = {}
+        self.subframe = None
+        self.last_valid = None
+        self.last_readout_time = 0.0
+        self.last_wait = 0.0
         self.ser.open()
         cam_log.info("Camera opened on port %s." % port)
         self.ping()
         self.ping()
+        if auto_baud:
+            self.negotiate_baudrate()
+        if self.pipeline:
+            self.measure_rtt()
+            # give every read the round trip on top of the usual timeout
+            self.ser.timeout = timeout + 2.0 * self.rtt
 
     def log_info(self, msg):
         cam_log.info(msg)
@@ -96,24 +276,38 @@ class AllSky340:
         return self.ser.baudrate
 
     def checksum(self, c):
-        inv = ~ord(c[0]) & 0xFF
-        mask = ~(1 << 7)
-        checksum = inv & mask
-        if len(c) > 1:
-            for i in range(1, len(c)):
-                inv = ~ord(c[i]) & 0xFF
-                xor = checksum ^ inv
-                checksum = xor & mask
-        return checksum
-
-    def command(self, cmd, nbytes):
-        to_send = cmd + struct.pack("B", self.checksum(cmd))
+        return checksum(c)
+
+    def command(self, cmd, nbytes, name=None):
+        """
+        send cmd with its checksum and read nbytes of response.  the stats
+        file it under name, by default the command itself, or its first
+        letter if it carries arguments.
+        """
+        to_send = FRAMED_COMMANDS.get(cmd)
+        if to_send is None:
+            to_send = cmd + struct.pack("B", checksum(cmd))
+            if name is None:
+                name = cmd[0]
+        elif name is None:
+            name = cmd
+        t0 = time.time()
         self.ser.write(to_send)
         if nbytes > 0:
-            return self.ser.read(nbytes)
+            resp = self.ser.read_exact(nbytes)
+            self.stats.observe("command." + name, time.time() - t0)
+            if len(resp) < nbytes:
+                self.stats.count("timeouts." + name)
+            return resp
         else:
+            self.stats.count("sent." + name)
             return True
 
+    def send_acks(self, n):
+        """send n block acks in one write, ahead of the blocks"""
+        self.ser.write(FRAMED_COMMANDS['K'] * n)
+        self.stats.count("sent.K", n)
+
     def ping(self):
         resp = self.command("E", 2)
         cam_log.info("Pinged camera and received response of %s" % resp)
@@ -122,6 +316,7 @@ class AllSky340:
             return True
         else:
             cam_log.warn("Comm problem. Did not receive correct response from camera.")
+            self.stats.count("ping_failures")
             return False
 
     def open_shutter(self):
@@ -138,15 +333,24 @@ class AllSky340:
 
     def abort_image(self):
         cam_log.info("Aborting current exposure")
+        # the exposure ends now rather than when scheduled
+        self.exposure_start = None
         return self.command("A", 0)
 
     def firmware(self):
-        resp = self.command("V", 2)
+        """
+        the version comes back as two bytes after the checksum echo.  the top
+        bit flags a "test" version, the rest of the upper byte is the major
+        version and the lower byte the minor version.
+        """
+        resp = self.command("V", 3)
+        if len(resp) == 3:
+            resp = resp[1:]
         minor = ord(resp[1])
         major = ord(resp[0])
-        if major >= 8:
+        if major >= 0x80:
             ver = "T"
-            major -= 8
+            major -= 0x80
         else:
             ver = "V"
         version = "%s%i.%i" % (ver, major, minor)
@@ -155,20 +359,14 @@ class AllSky340:
         return version
 
     def set_baudrate(self, baud):
+        t0 = time.time()
         old_baud = self.ser.baudrate
         cam_log.info("Setting camera baudrate to %d" % baud)
-        cmds = {9600:   "B0",
-                19200:  "B1",
-                38400:  "B2",
-                57600:  "B3",
-                115200: "B4",
-                230400: "B5",
-                460800: "B6"}
-        if baud not in cmds.keys():
+        if baud not in BAUDRATES:
             cam_log.error("NOT A VALID BAUDRATE!")
             return False
         else:
-            cmd = cmds[baud]
+            cmd = BAUDRATES[baud]
             self.command(cmd, 0)
             self.ser.baudrate = baud
             resp = self.ser.read(2)
@@ -178,12 +376,145 @@ class AllSky340:
             if resp[:-1] == "TestOk":
                 cam_log.info("Camera accepted new baudrate.")
                 self.command("k", 0)
+                self.stats.observe("set_baudrate", time.time() - t0)
+                self.stats.count("baud_changes")
                 return True
             else:
                 cam_log.warn("Camera did not accept new baudrate. Resetting to previous rate.")
                 self.ser.baudrate = old_baud
+                self.stats.observe("set_baudrate", time.time() - t0)
+                self.stats.count("baud_change_failures")
                 return False
 
+    def find_baudrate(self, timeout=0.1):
+        """
+        the camera keeps the last rate it was set to in non-volatile memory
+        and comes up at that after a power cycle, so it could be at any of
+        them.  ping it at the one we were opened at first, then at each of
+        the others.  returns the rate it answered at, or None.
+        """
+        old_timeout = self.ser.timeout
+        self.ser.timeout = timeout
+        try:
+            for baud in [self.ser.baudrate] + sorted(BAUDRATES):
+                self.ser.baudrate = baud
+                self.ser.flushInput()
+                if self.ping():
+                    cam_log.info("Found camera at %d baud" % baud)
+                    return baud
+        finally:
+            self.ser.timeout = old_timeout
+        cam_log.error("Camera did not answer at any baudrate.")
+        return None
+
+    def negotiate_baudrate(self):
+        """
+        find the camera and move it to the fastest rate that passes the Test
+        handshake, trying them from the top down.  every B command rewrites
+        the camera's non-volatile memory, so if it's already at the fastest
+        rate (as it will be after the first time) none is sent, and a rate
+        is only tried if it's faster than the one the camera is at.  returns
+        the rate in use.
+        """
+        current = self.find_baudrate()
+        if current is None:
+            return None
+        for baud in sorted(BAUDRATES, reverse=True):
+            if baud <= current or baud < self.min_baud:
+                break
+            if self.set_baudrate(baud) and self.ping():
+                break
+            # set_baudrate() went back to the old rate if the handshake
+            # failed; a failed ping leaves us at one that doesn't work
+            if self.ser.baudrate != current:
+                self.set_baudrate(current)
+        # rates above the one that worked didn't, the ones below it are
+        # assumed to until adapt_baudrate() finds otherwise
+        self.usable_bauds = [b for b in sorted(BAUDRATES)
+                             if self.min_baud <= b <= self.ser.baudrate] or \
+            [self.ser.baudrate]
+        cam_log.info("Usable baudrates: %s, using %d" %
+                     (self.usable_bauds, self.ser.baudrate))
+        return self.ser.baudrate
+
+    def measure_rtt(self, n=5):
+        """
+        time n pings and keep the quickest, less the time its four bytes
+        spend on the wire, as self.rtt.  returns it.
+        """
+        best = None
+        for i in range(n):
+            t0 = time.time()
+            resp = self.command("E", 2)
+            dt = time.time() - t0
+            if len(resp) == 2 and (best is None or dt < best):
+                best = dt
+        if best is None:
+            cam_log.warn("Could not measure the round trip to the camera.")
+            return self.rtt
+        self.rtt = max(0.0, best - 4 * 10.0 / self.ser.baudrate)
+        self.stats.observe("rtt", self.rtt)
+        cam_log.info("Round trip to camera is %.1f ms" % (1000.0 * self.rtt))
+        return self.rtt
+
+    def ack_window(self, npix):
+        """
+        how many block acks to keep in flight during a readout.  1, the
+        usual one ack per block, unless pipelining.  otherwise enough to
+        cover the round trip with blocks of npix pixels at the current
+        baudrate, plus the one being read, up to max_window.
+        """
+        if not self.pipeline:
+            return 1
+        block_time = (npix * 2 + 1) * 10.0 / self.ser.baudrate
+        window = 1 + int(math.ceil(self.rtt / block_time))
+        return max(1, min(window, self.max_window))
+
+    def effective_rate(self, baud):
+        """
+        expected image bytes/s at baud.  every re-sent block costs a whole
+        block's worth of time on the wire, so it's the raw rate (10 bits per
+        byte) scaled by the fraction of transfers that get through.
+        """
+        return baud / 10.0 * (1.0 - self.link_errors.get(baud, 0.0))
+
+    def adapt_baudrate(self, alpha=0.5, decay=0.9, margin=0.1):
+        """
+        call between frames, with the camera idle.  folds the fraction of
+        block transfers that were re-sent during the last readout into a
+        running average for the current rate (weight alpha), and moves to
+        the next rate down or up if that's expected to be faster by more
+        than margin.  the averages for the other rates decay towards zero
+        each frame, since the error bursts come and go, so after a while a
+        faster rate gets tried again.  returns the rate in use.
+        """
+        baud = self.ser.baudrate
+        if self.last_valid is None or baud not in self.usable_bauds:
+            return baud
+        ntransfers = len(self.last_valid) + self.retransmits
+        frac = float(self.retransmits) / ntransfers
+        for b in self.link_errors:
+            if b != baud:
+                self.link_errors[b] *= decay
+        self.link_errors[baud] = alpha * frac + \
+            (1.0 - alpha) * self.link_errors.get(baud, frac)
+
+        i = self.usable_bauds.index(baud)
+        best = baud
+        for j in (i - 1, i + 1):
+            if j < 0 or j >= len(self.usable_bauds):
+                continue
+            b = self.usable_bauds[j]
+            if self.effective_rate(b) > \
+                    self.effective_rate(best) * (1.0 + margin):
+                best = b
+        if best != baud:
+            cam_log.warn("%.1f%% of blocks re-sent at %d baud. Switching to %d."
+                         % (100.0 * self.link_errors[baud], baud, best))
+            if not self.set_baudrate(best):
+                self.link_errors[best] = 1.0
+        return self.ser.baudrate
+
     def heater_on(self):
         """
         per communication with SBIG, the heater is wired to the X+ guide relay
@@ -216,53 +547,209 @@ class AllSky340:
         self.command(cmd, 0)
         return True
 
-    def block_read(self, npix, ntries=0, lrc_byte=None):
+    def set_subframe(self, x, y, size):
         """
-        cheeky recursive function to read block of pixels and ask for repeat
-        transmissions if checksums don't match
+        define the region read out in "subframe" mode: size x size pixels
+        (at most 127) with the corner at column x and row y of the full frame.
+        rows are counted in the camera's orientation, i.e. before any flip.
         """
-        max_tries = 5
-        block = self.ser.read(npix * 2)
-        if lrc_byte == None:
-            lrc_byte = self.ser.read(1)
-        if len(lrc_byte) > 0:
-            cam_lrc = ord(lrc_byte)
-        else:
-            cam_lrc = 0
-        lrc = 0
-        for b in block:
-            lrc ^= ord(b)
-        if lrc == cam_lrc:
-            return block
-        else:
-            if ntries < max_tries:
-                cam_log.warn("Camera read-out error. Re-transmitting block (try #%d)..."
-                             % ntries)
-                self.command('R', 0)
-                # not sure why this is needed. not mentioned in document...
-                # f = self.ser.read(1)
-                return self.block_read(npix, ntries=ntries+1, lrc_byte=lrc_byte)
+        if size < 1 or size > 127 or x < 0 or y < 0 or \
+                x + size > 640 or y + size > 480:
+            cam_log.error("Invalid sub-frame %d x %d at (%d, %d)" %
+                          (size, size, x, y))
+            return False
+        cmd = "S" + struct.pack(">HHB", x, y, size)
+        cam_log.info("Setting sub-frame to %d x %d at (%d, %d)" %
+                     (size, size, x, y))
+        # not to be counted with the S that stops a transfer
+        self.command(cmd, 0, name="subframe")
+        self.subframe = (x, y, size)
+        return True
+
+    def frame_buffer(self, npixels, slot=0):
+        """
+        return the reusable raw readout buffer for frames of npixels pixels.
+        sequence() alternates between two slots so one frame can be handed
+        out while the next is read into the other.  recover_blocks() uses
+        the "scratch" slot and skycamd's client exposures the "client" one.
+        """
+        buf = self.frames.get((npixels, slot))
+        if buf is None:
+            buf = bytearray(npixels * 2)
+            self.frames[(npixels, slot)] = buf
+        return buf
+
+    def block_read(self, npix, buf, offset):
+        """
+        read a block of pixels straight into buf at offset.  if the LRC
+        doesn't match ask the camera to re-transmit the block, backing off a
+        bit more each time, until it comes through or we run out of tries.
+        retransmissions overwrite the block in place.  returns True if a good
+        copy of the block was received.
+        """
+        nbytes = npix * 2
+        view = memoryview(buf)[offset:offset + nbytes]
+        block = np.frombuffer(buf, dtype=np.uint8, count=nbytes, offset=offset)
+        delay = self.retry_backoff
+        ntries = 0
+        t0 = time.time()
+        while True:
+            # the pixels go straight into buf, the LRC byte through the
+            # port's buffer
+            nread = self.ser.read_exact(nbytes, into=view)
+            lrc_byte = self.ser.read_exact(1)
+            if nread < nbytes or len(lrc_byte) == 0:
+                self.stats.count("short_blocks")
+            elif block_lrc(block) == ord(lrc_byte):
+                self.stats.observe("block", time.time() - t0)
+                return True
             else:
-                cam_log.error("Camera read_out failed. Stopping transfer.")
-                #self.command('S', 0)
+                self.stats.count("lrc_failures")
+            if ntries >= self.max_retries:
+                cam_log.error("Camera read-out of block failed after %d tries."
+                              % (ntries + 1))
+                self.stats.observe("block", time.time() - t0)
+                self.stats.count("failed_blocks")
                 return False
+            ntries += 1
+            self.retransmits += 1
+            self.stats.count("retransmits")
+            self.retry_log.warn("Camera read-out error. Re-transmitting block "
+                                "(try #%d)...", ntries)
+            if delay > 0:
+                time.sleep(delay)
+                delay *= self.backoff_factor
+            # toss anything left over from the bad block so the resent block
+            # and its fresh LRC byte start on a clean slate.
+            self.ser.flushInput()
+            self.command('R', 0)
 
-    def getImage(self, exptime, light=False, cropped=False):
+    def pipelined_block_read(self, npix, buf, offset):
+        """
+        read a block whose ack has already been sent, so there's no asking
+        for it again.  returns True if it's good, False if its LRC doesn't
+        match and None if it didn't all arrive, in which case we've lost
+        track of where the camera is in the transfer.
+        """
+        nbytes = npix * 2
+        view = memoryview(buf)[offset:offset + nbytes]
+        block = np.frombuffer(buf, dtype=np.uint8, count=nbytes, offset=offset)
+        t0 = time.time()
+        nread = self.ser.read_exact(nbytes, into=view)
+        lrc_byte = self.ser.read_exact(1)
+        self.stats.observe("block", time.time() - t0)
+        if nread < nbytes or len(lrc_byte) == 0:
+            self.stats.count("short_blocks")
+            return None
+        if block_lrc(block) != ord(lrc_byte):
+            self.stats.count("lrc_failures")
+            # it'll be transferred again in the second pass
+            self.retransmits += 1
+            self.retry_log.warn("Camera read-out error in pipelined block. "
+                                "Leaving it for the second pass.")
+            return False
+        return True
+
+    def skip_block(self, npix, buf):
+        """
+        read a block we already have a good copy of into buf, LRC byte and
+        all, and forget about it: no retries and nothing in the stats.
+        returns False if it didn't all arrive.
+        """
+        nbytes = npix * 2
+        nread = self.ser.read_exact(nbytes, into=memoryview(buf)[:nbytes])
+        return nread == nbytes and len(self.ser.read_exact(1)) == 1
+
+    def recover_blocks(self, npix, buf, valid):
+        """
+        second pass over blocks that failed during the readout.  the image
+        stays in the camera's frame buffer so we can simply ask for it again.
+        blocks we already have are read into a scratch buffer with
+        skip_block() and acked, the failed ones are read into buf, and the transfer is stopped as soon as
+        the last of them has been read.  valid is updated in place.
+
+        when pipelining, the acks for blocks we already have are sent ahead
+        of them, up to the next failed block, which is acked as usual once
+        it's been checked.
+        """
+        bad = np.flatnonzero(~valid)
+        if len(bad) == 0:
+            return valid
+        cam_log.warn("Re-transferring image to recover %d bad block(s)..."
+                     % len(bad))
+        nbytes = npix * 2
+        # a block's worth of pixels can also be a whole subframe, so the
+        # scratch buffer gets a slot of its own
+        scratch = self.frame_buffer(npix, slot="scratch")
+        last = bad[-1]
+        window = self.ack_window(npix)
+        acked = 0
+        self.command('X', 0)
+        self.ser.read_exact(1)
+        for i in range(last + 1):
+            if valid[i]:
+                if window > 1:
+                    next_bad = bad[np.searchsorted(bad, i)]
+                    n = min(i + window, next_bad) - acked
+                    if n > 0:
+                        self.send_acks(n)
+                        acked += n
+                if not self.skip_block(npix, scratch):
+                    cam_log.warn("Lost track of transfer at block %d. "
+                                 "Stopping transfer." % i)
+                    last = -1
+                    break
+                if window > 1:
+                    continue
+            else:
+                valid[i] = self.block_read(npix, buf, i * nbytes)
+            if i < last:
+                self.command('K', 0)
+                acked = i + 1
+        if last == len(valid) - 1:
+            self.command('K', 0)
+            self.ser.drain_trailer(5)
+        else:
+            # stop the transfer here and throw away whatever was in flight
+            self.command('S', 0)
+            time.sleep(self.ser.timeout)
+            self.ser.flushInput()
+        if valid.all():
+            cam_log.info("Recovered all bad blocks.")
+        else:
+            cam_log.error("%d block(s) could not be recovered."
+                          % np.sum(~valid))
+        return valid
+
+    def expose(self, exptime, light=False, cropped=False, mode=None):
+        """
+        start an exposure.  returns as soon as the command has been sent; use
+        wait_exposure() to wait for it to finish.  mode is one of "full",
+        "cropped", "bin2x2" or "subframe" and overrides cropped.
+        """
+        mode = readout_mode(mode, cropped)
+        if mode == "subframe" and self.subframe is None:
+            raise ValueError("No sub-frame defined. Use set_subframe() first.")
         eres = 1.0e-4
         e = "%06x" % int(exptime / eres)
+        # readout mode byte.  the camera only sends a cropped, binned or
+        # sub-frame image if it's asked for one.
+        e = e + "%02x" % MODE_BYTES[mode]
         if light:
-            e = e + "00" + "01"
+            e = e + "01"
         else:
-            e = e + "00" + "00"
+            e = e + "00"
 
         etime = e.decode("hex")
         command = "T" + etime
-        self.command(command, 0)
-
-        if cropped:
-            crop = "cropped"
-        else:
-            crop = "full"
+        # the camera echoes the checksum of the T command.  read it here so
+        # it can't be mistaken for the 'D' at the end of the exposure.
+        echo = self.command(command, 1)
+        self.exposure_start = time.time()
+        self.exposure_time = exptime
+        if echo != chr(checksum(command)):
+            cam_log.warn("Unexpected response of %r to exposure command." %
+                         echo)
 
         if light:
             imtype = "light"
@@ -270,63 +757,439 @@ class AllSky340:
             imtype = "dark"
 
         cam_log.info("Exposing %s %s image for %f seconds...." %
-                     (crop, imtype, exptime))
+                     (mode, imtype, exptime))
 
+    def wait_exposure(self, timeout=None):
+        """
+        wait for the camera to say the exposure is done and read out.  waits
+        forever by default, otherwise gives up after timeout seconds and
+        returns False.
+
+        with scheduled_wait set it first sleeps until wake_margin seconds
+        before the exposure should be done, going by the exposure time and
+        the camera overhead measured on earlier exposures, and only then
+        starts reading the port.  the progress bytes the camera sent in the
+        meantime are picked up in one go.
+        """
+        now = t0 = time.time()
+        if timeout is not None:
+            deadline = now + timeout
+        expected = None
+        if self.exposure_start is not None:
+            expected = self.exposure_start + self.exposure_time + self.overhead
         out = "E"
-        s = ""
+        early = False
+        if self.scheduled_wait and expected is not None:
+            wake = expected - self.wake_margin
+            if timeout is not None:
+                wake = min(wake, deadline)
+            if wake > now:
+                time.sleep(wake - now)
+            backlog = self.ser.read(self.ser.inWaiting())
+            if "D" in backlog:
+                out = "D"
+                early = True
         while out != "D":
-            out = self.ser.read(1)
+            if timeout is not None and time.time() > deadline:
+                cam_log.warn("Timed out waiting for exposure to finish.")
+                self.stats.count("exposure_timeouts")
+                return False
+            # the progress bytes before the 'D' are of no interest
+            out = self.ser.read_until("D")[-1:]
+        self.last_wait = time.time() - t0
+        self.stats.observe("exposure_wait", self.last_wait)
+        if expected is not None:
+            self.record_timing(time.time() - expected, early)
+        return True
+
+    def record_timing(self, lateness, early=False, alpha=0.2):
+        """
+        fold how late the end of the last exposure was, compared to what we
+        expected, into the overhead estimate.  if the 'D' was already waiting
+        when wait_exposure() woke up we only know it came some time before
+        that, which still pulls the estimate down, just not all the way.
+        """
+        overhead = self.overhead + lateness
+        self.exposure_timing.append((self.exposure_time, overhead, lateness))
+        if early:
+            cam_log.info("Exposure was already done when we woke up, %.3f s "
+                         "before it was expected." % -lateness)
+        self.overhead = max(0.0, self.overhead + alpha * lateness)
+        self.exposure_start = None
+        self.stats.observe("camera_overhead", max(0.0, overhead))
+
+    def readout(self, cropped=False, flip=True, slot=0, mode=None):
+        """
+        transfer the last exposure from the camera.  this is a generator that
+        yields a Block as soon as each block of pixels has been read and its
+        LRC checked, so callers can start working on the frame while the rest
+        of it is still coming down the wire.  the camera is already sending
+        the next block while the caller handles the current one.
+
+        Block.image is a uint16 view of the whole frame buffer (flipped if
+        flip is set) that fills in as the readout goes, Block.rows the rows
+        of it this block landed in, and Block.pixels the block's own pixels.
+        blocks that fail are yielded with valid=False and, if they're
+        recovered in the second pass, yielded again at the end.  the
+        per-block validity mask is left in self.last_valid.  slot picks which
+        of the frame buffers for this mode to read into.  mode has to match
+        the one the exposure was taken in.
+
+        when pipelining (see ack_window()) blocks are acked before they've
+        been checked, so a bad one can't be re-sent straight away.  it's
+        left for the second pass instead.
+        """
+        mode = readout_mode(mode, cropped)
+        nrows, ncols, npix = readout_geometry(mode, self.subframe)
+        npixels = nrows * ncols
+        nblocks = npixels / npix
+        nbytes = npix * 2
+        buf = self.frame_buffer(npixels, slot)
+        image = decode_image(buf, (nrows, ncols), flip=flip)
+        flat = np.frombuffer(buf, dtype='<u2')
+        valid = np.ones(nblocks, dtype=bool)
+        self.last_valid = valid
+        self.retransmits = 0
+        t0 = time.time()
+
+        def block(i, ndone):
+            r0 = i * npix / ncols
+            r1 = -(-(i + 1) * npix / ncols)
+            if flip:
+                rows = slice(nrows - r1, nrows - r0)
+            else:
+                rows = slice(r0, r1)
+            elapsed = time.time() - t0
+            if elapsed > 0:
+                rate = np.sum(valid[:ndone]) * nbytes / elapsed
+            else:
+                rate = 0.0
+            return Block(i, nblocks, bool(valid[i]), image, rows,
+                         flat[i * npix:(i + 1) * npix],
+                         float(ndone) / nblocks, elapsed, rate)
 
         cam_log.info("Transferring image from camera....")
-        self.command('X', 0)
-        imag_str = bytearray()
+        finished = False
+        try:
+            self.command('X', 0)
 
-        # not sure why this is needed. not mentioned in document...
-        f = self.ser.read(1)
+            # not sure why this is needed. not mentioned in document...
+            f = self.ser.read_exact(1)
 
-        # we only use 1x1 binning and either full or cropped
-        if cropped:
-            nbytes = 245760
-        else:
-            nbytes = 307200
-
-        # this is true for 1x1 binning.  it would be 1024 for 2x2 binning
-        # or the length of one line in sub-frame mode.
-        npix = 4096
-        for i in range(nbytes / npix):
-            block_str = self.block_read(npix)
-            # if the read completely fails, just replace with zeros
-            if block_str == False:
-                l = npix*[0]
-                block_str = struct.pack('B' * len(l), *l)
-            imag_str.extend(block_str)
-            self.command('K', 0)
+            window = self.last_window = self.ack_window(npix)
+            acked = 0
+            lost = False
+            for i in range(nblocks):
+                if window > 1:
+                    # keep window acks ahead of the block being read so the
+                    # camera never has to wait on the round trip for one
+                    n = min(i + window, nblocks) - acked
+                    if n > 0:
+                        self.send_acks(n)
+                        acked += n
+                    ok = self.pipelined_block_read(npix, buf, i * nbytes)
+                    if ok is None:
+                        cam_log.warn("Lost track of pipelined transfer at "
+                                     "block %d. Stopping transfer." % i)
+                        valid[i:] = False
+                        lost = True
+                        break
+                    valid[i] = ok
+                else:
+                    valid[i] = self.block_read(npix, buf, i * nbytes)
+                    self.command('K', 0)
+                yield block(i, i + 1)
 
-        # pull these extra bytes out.  also not sure why...
-        cam = self.ser.read(1)
-        cam = self.ser.read(1)
-        cam = self.ser.read(1)
-        cam = self.ser.read(1)
-        cam = self.ser.read(1)
+            if lost:
+                self.command('S', 0)
+                time.sleep(self.ser.timeout)
+                self.ser.flushInput()
+            else:
+                # pull these extra bytes out.  also not sure why...
+                self.ser.drain_trailer(5)
+            finished = True
 
-        # this is ugly and there has to be a better way, but it works.
-        earr = [z for z in imag_str[::2]]
-        oarr = [z for z in imag_str[1::2]]
-        arr = []
+            if self.second_pass and not valid.all():
+                bad = ~valid
+                self.recover_blocks(npix, buf, valid)
+                for i in np.flatnonzero(bad & valid):
+                    yield block(i, nblocks)
+        finally:
+            if not finished:
+                # caller bailed out part way through so stop the transfer
+                cam_log.warn("Image transfer abandoned. Stopping transfer.")
+                self.command('S', 0)
+                time.sleep(self.ser.timeout)
+                self.ser.flushInput()
 
-        for i in range(len(earr)):
-            s = struct.pack("BB", earr[i], oarr[i])
-            n = struct.unpack("H", s)[0]
-            arr.append(n)
+        # zero out anything we couldn't get rather than leave garbage there.
+        # these are flagged in the validity mask.
+        for i in np.flatnonzero(~valid):
+            flat[i * npix:(i + 1) * npix] = 0
+        self.last_readout_time = time.time() - t0
+        self.readout_done(mode, valid, nbytes)
 
-        if cropped:
-            imag = np.array(arr, dtype=np.int32).reshape(480, 512)
+    def readout_done(self, mode, valid, nbytes):
+        """update the stats and the last_frame summary after a readout"""
+        nbad = int(np.sum(~valid))
+        self.stats.observe("readout", self.last_readout_time)
+        self.stats.count("readouts")
+        self.stats.count("zero_filled_blocks", nbad)
+        if self.last_readout_time > 0:
+            rate = (len(valid) - nbad) * nbytes / self.last_readout_time
         else:
-            imag = np.array(arr, dtype=np.int32).reshape(480, 640)
-        return np.flipud(imag)
+            rate = 0.0
+        self.last_frame = {"mode": mode,
+                           "exptime": self.exposure_time,
+                           "baudrate": self.ser.baudrate,
+                           "exposure_wait": self.last_wait,
+                           "readout": self.last_readout_time,
+                           "blocks": len(valid),
+                           "retransmits": self.retransmits,
+                           "ack_window": self.last_window,
+                           "zero_filled_blocks": nbad,
+                           "bytes_per_sec": rate}
+
+    def frame_done(self, frame_time=None):
+        """
+        called once a frame has been handed over.  records how long it took
+        and writes report() to stats_file if there is one.
+        """
+        if frame_time is not None:
+            self.last_frame["frame"] = frame_time
+            self.stats.observe("frame", frame_time)
+        if self.stats_file:
+            try:
+                dump_json(self.report(), self.stats_file)
+            except (IOError, OSError), err:
+                cam_log.warn("Could not write stats to %s: %s" %
+                             (self.stats_file, err))
+
+    def report(self):
+        """
+        everything we know about how the link and the camera are doing, as a
+        dict that can be written out as JSON.  compare last_frame's
+        exposure_wait against exptime for how slow the camera is, and its
+        bytes_per_sec and retransmits against the baudrate for the link.
+        """
+        return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "baudrate": self.ser.baudrate,
+                "overhead": self.overhead,
+                "rtt": self.rtt,
+                "last_frame": dict(self.last_frame),
+                "stats": self.stats.as_dict(),
+                "transport": self.ser.stats()}
+
+    def transfer_time(self, cropped=False, mode=None):
+        """
+        how long we expect a readout to take, in seconds.  the larger of what
+        the last readout actually took and the raw time on the wire at the
+        current baudrate (10 bits per byte).
+        """
+        mode = readout_mode(mode, cropped)
+        nrows, ncols, npix = readout_geometry(mode, self.subframe)
+        wire = nrows * ncols * 2 * 10.0 / self.ser.baudrate
+        return max(wire, self.last_readout_time)
+
+    def sequence(self, exptime, light=True, cropped=False, dtype="uint16",
+                 flip=True, overlap=True, mode=None, idle=None):
+        """
+        take exposures back to back, yielding a Frame for each one.  the next
+        exposure is always started before a frame is handed out, so whatever
+        the caller does with it (stats, writing FITS and JPEGs, ...) happens
+        while the camera is integrating.
+
+        with overlap set, the next exposure is started before the readout
+        too.  the camera supports this: if an exposure ends while a download
+        is still going, it parks the charge in the readout pixels until the
+        download is done.  those pixels have a higher dark current though, so
+        this is only done when the exposure is longer than transfer_time().
+        the image stays in the camera's frame buffer only until that next
+        exposure is read out, so there's no second pass for bad blocks in
+        overlapped frames.  they're just zeroed and flagged in Frame.valid.
+
+        frames are read into two buffers alternately, so with the default
+        uint16 dtype Frame.image is a view that stays good until the frame
+        after next is read.  send() the generator a new exptime, or an
+        (exptime, light) tuple, to change the exposure.  because the next
+        exposure has already started by then, the change applies to the frame
+        after next.
+
+        idle is for anything else that needs the camera now and then, like a
+        skycamd.CameraDaemon: it needs pending() and run_pending().  when
+        something is pending the next exposure isn't overlapped with the
+        readout, and run_pending() is called once the frame is read out and
+        before the next exposure starts, so the sequence carries on
+        afterwards without losing a frame.
+        """
+        mode = readout_mode(mode, cropped)
+        cropped = mode == "cropped"
+        settings = current = (exptime, light)
+        self.expose(exptime, light=light, mode=mode)
+        started = time.time()
+        self.wait_exposure()
+        nrows, ncols, npix = readout_geometry(mode, self.subframe)
+        slot = 0
+        pending = False
+        second_pass = self.second_pass
+        try:
+            while True:
+                nxt = settings
+                busy = idle is not None and idle.pending()
+                overlapped = overlap and not busy and \
+                    nxt[0] > self.transfer_time(mode=mode)
+                if overlapped:
+                    self.expose(nxt[0], light=nxt[1], mode=mode)
+                    next_started = time.time()
+                    pending = True
+                    self.second_pass = False
+                for block in self.readout(flip=flip, slot=slot, mode=mode):
+                    pass
+                self.second_pass = second_pass
+                valid = self.last_valid.copy()
+                if not overlapped:
+                    if busy:
+                        idle.run_pending()
+                    self.expose(nxt[0], light=nxt[1], mode=mode)
+                    next_started = time.time()
+                    pending = True
+
+                buf = self.frame_buffer(nrows * ncols, slot)
+                imag = decode_image(buf, (nrows, ncols), dtype=dtype,
+                                    flip=flip)
+                self.frame_done()
+                msg = yield Frame(imag, valid, current[0], current[1],
+                                  cropped, started, mode)
+                if msg is not None:
+                    if isinstance(msg, tuple):
+                        settings = msg
+                    else:
+                        settings = (msg, settings[1])
+
+                self.wait_exposure()
+                pending = False
+                if self.auto_baud:
+                    self.adapt_baudrate()
+                current = nxt
+                started = next_started
+                slot ^= 1
+        finally:
+            self.second_pass = second_pass
+            if pending:
+                # the camera reads out what it has when aborted and then
+                # says it's done as usual
+                self.abort_image()
+                self.wait_exposure(timeout=10.0)
+
+    def getImage(self, exptime, light=False, cropped=False,
+                 dtype="uint16", flip=True, copy=True, with_mask=False,
+                 mode=None, slot=0):
+        """
+        take an exposure and read it out.  the image is returned as native
+        uint16 by default; pass dtype (e.g. np.int32) if you need headroom for
+        arithmetic like dark subtraction.  see decode_image() for flip.
+
+        the pixels are read into a frame buffer that is reused for every
+        exposure of the same size.  copy=False hands back a view onto that
+        buffer instead of a copy, which saves allocating a new frame but is
+        only valid until the next readout in the same mode.
+
+        blocks that couldn't be read even after retries and the second pass
+        are zero-filled.  with_mask=True returns (image, valid) where valid is
+        a boolean array with one entry per block; see pixel_mask() to turn
+        that into a mask matching the image.
+
+        mode selects the readout mode instead of cropped: "bin2x2" for 2x2
+        binned 320x240 frames, or "subframe" for the region given to
+        set_subframe().  slot picks the frame buffer, see frame_buffer().
+        """
+        mode = readout_mode(mode, cropped)
+        t0 = time.time()
+        self.expose(exptime, light=light, mode=mode)
+        self.wait_exposure()
+        for block in self.readout(flip=flip, slot=slot, mode=mode):
+            pass
+        self.frame_done(time.time() - t0)
+        if self.auto_baud:
+            self.adapt_baudrate()
+
+        nrows, ncols, npix = readout_geometry(mode, self.subframe)
+        buf = self.frame_buffer(nrows * ncols, slot)
+        imag = decode_image(buf, (nrows, ncols), dtype=dtype, flip=flip)
+        if copy and not imag.flags.owndata:
+            imag = imag.copy()
+        if with_mask:
+            return imag, self.last_valid
+        return imag
+
+
+def decode_image(buf, shape, dtype="uint16", flip=True):
+    """
+    decode the raw pixel buffer read from the camera into an image of the
+    given shape.  pixels come over the wire least significant byte first so
+    this is just a little-endian uint16 view onto buf.  no copy is made unless
+    dtype asks for a conversion (or the host is big-endian).  flip=True
+    returns the image flipped top-to-bottom as we've always displayed it,
+    flip=False gives the rows in the order the camera sent them.
+    """
+    imag = np.frombuffer(buf, dtype='<u2').reshape(shape)
+    if flip:
+        imag = imag[::-1]
+    if imag.dtype != np.dtype(dtype):
+        imag = imag.astype(dtype)
+    return imag
+
+def pixel_mask(valid, shape, npix=None, flip=True):
+    """
+    expand a per-block validity mask from getImage into a boolean mask with
+    the same shape (and orientation) as the image.  blocks don't necessarily
+    cover whole rows, e.g. 4096 pixels is 6.4 rows of a full frame.  npix,
+    the pixels per block, is worked out from the shape if not given.
+    """
+    if npix is None:
+        npix = -(-shape[0] * shape[1] // len(valid))
+    mask = np.repeat(valid, npix)[:shape[0] * shape[1]].reshape(shape)
+    if flip:
+        mask = mask[::-1]
+    return mask
 
 if __name__ == '__main__':
-    c = AllSky340()
+    # python AllSky340.py command [args].  if the camera daemon is running the
+    # command goes to it (see skycamctl.py), otherwise the camera is opened
+    # and the method of the same name called.  arguments are name=value
+    # pairs or plain values, read as JSON where possible.
+    import os
+    import json
+    import errno
+    import socket
+    from skycamd import SOCKET_PATH, CAMERA_COMMANDS
+    from skycamctl import request
+
     method = sys.argv[1].lower()
-    args = ", ".join(sys.argv[2:])
-    eval("c.%s(%s)" % (method, args))
+    args = []
+    kwargs = {}
+    for arg in sys.argv[2:]:
+        name, sep, value = arg.partition("=")
+        if not sep:
+            name, value = None, arg
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        if name is None:
+            args.append(value)
+        else:
+            kwargs[name] = value
+    direct = True
+    if os.path.exists(SOCKET_PATH) and not args:
+        try:
+            print(request(method, **kwargs))
+            direct = False
+        except socket.error, err:
+            # left behind by a daemon that didn't shut down cleanly
+            if err.args[0] not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+    if direct:
+        c = AllSky340(port=os.environ.get("SKYCAM_PORT",
+                                          "/dev/tty.usbserial"))
+        print(getattr(c, CAMERA_COMMANDS.get(method, method))(*args, **kwargs))
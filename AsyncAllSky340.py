@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+                AsyncAllSky340
+
+Event-loop driver for the SBIG AllSky340.  AsyncAllSky340 is an AllSky340
+whose reads are coroutines: instead of blocking in ser.read() the port is
+registered with the event loop and a read only wakes up when the camera has
+actually sent something.  Waiting out a 60 s exposure costs one wakeup per
+progress tick from the camera and leaves the loop free the rest of the time,
+so acquisition can share a process with a web server, uploads, etc.
+
+This is Python 2 code so it runs on trollius, the asyncio backport: write
+"yield From(...)" where asyncio has "await" and "raise Return(x)" for
+returning a value from a coroutine.
+
+    loop = asyncio.get_event_loop()
+    cam = AsyncAllSky340(port="/dev/ttyUSB0", baudrate=460800, timeout=0.1)
+    imag = loop.run_until_complete(cam.getImage(60.0, light=True))
+
+Opening the camera and the commands that aren't overridden here (ping,
+set_baudrate, firmware, ...) still use the blocking calls from AllSky340.
+They're quick, but don't mix them with a coroutine that's in the middle of
+talking to the camera.
+sequence() is blocking too; loop over getImage() instead.
+
+The port has to be a local serial device, since the loop watches its file
+descriptor; rfc2217:// and socket:// URLs are turned down, and so is
+pipelining the block acks, which is only for those.  scheduled_wait works
+as in AllSky340, with the loop free while it sleeps.
+"""
+
+import time
+import trollius as asyncio
+from trollius import From, Return
+
+from AllSky340 import AllSky340, Block, readout_mode, readout_geometry, \
+    decode_image, block_lrc, cam_log
+from lazyimport import lazy_import
+
+np = lazy_import("numpy")
+
+
+class AsyncAllSky340(AllSky340):
+    def __init__(self, port="/dev/tty.usbserial", loop=None, **kwargs):
+        """
+        takes the same arguments as AllSky340, plus the event loop to use
+        (the default one if not given).  port can't be a URL and pipeline
+        can't be set.
+        """
+        if "://" in port:
+            raise ValueError("AsyncAllSky340 needs a local serial port, not "
+                             "%s" % port)
+        if kwargs.get("pipeline"):
+            raise ValueError("AsyncAllSky340 doesn't pipeline block acks")
+        kwargs["pipeline"] = False
+        AllSky340.__init__(self, port=port, **kwargs)
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        # how many times a read woke up to find data waiting
+        self.wakeups = 0
+
+    @asyncio.coroutine
+    def read_into(self, view, timeout=None):
+        """
+        fill memoryview view from the serial port, reading whatever has
+        arrived each time the port becomes readable.  gives up after timeout
+        seconds (the port's timeout by default).  returns the number of bytes
+        read, which is short only if it timed out.
+        """
+        n = len(view)
+        if n == 0:
+            raise Return(0)
+        if timeout is None:
+            timeout = self.ser.timeout
+        got = [0]
+        done = asyncio.Future(loop=self.loop)
+
+        def readable():
+            avail = min(self.ser.inWaiting(), n - got[0])
+            if avail > 0:
+                got[0] += self.ser.readinto(view[got[0]:got[0] + avail])
+            if got[0] >= n and not done.done():
+                done.set_result(None)
+
+        # some of it may already be sitting in the port's buffer, and that
+        # won't make the port readable
+        readable()
+        if done.done():
+            raise Return(got[0])
+        fd = self.ser.fileno()
+        def wakeup():
+            self.wakeups += 1
+            readable()
+
+        self.loop.add_reader(fd, wakeup)
+        try:
+            yield From(asyncio.wait_for(done, timeout, loop=self.loop))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.loop.remove_reader(fd)
+        raise Return(got[0])
+
+    @asyncio.coroutine
+    def read(self, nbytes, timeout=None):
+        """read up to nbytes, returned as a string like ser.read()"""
+        buf = bytearray(nbytes)
+        got = yield From(self.read_into(memoryview(buf), timeout))
+        raise Return(str(buf[:got]))
+
+    @asyncio.coroutine
+    def request(self, cmd, nbytes):
+        """
+        send a command and wait for nbytes of response.  this is command()
+        for coroutines; command() itself stays blocking because the
+        inherited methods rely on it.
+        """
+        self.command(cmd, 0)
+        resp = yield From(self.read(nbytes))
+        raise Return(resp)
+
+    @asyncio.coroutine
+    def wait_exposure(self, timeout=None):
+        """
+        wait for the camera to say the exposure is done and read out.  the
+        camera sends an 'E' every 150 ms while exposing and an 'R' while
+        reading out, and each of those is a single wakeup.  waits forever by
+        default, otherwise gives up after timeout seconds and returns False.
+        with scheduled_wait set it sleeps until wake_margin seconds before
+        the exposure should be done first, as AllSky340.wait_exposure does.
+        """
+        now = t0 = time.time()
+        if timeout is not None:
+            deadline = t0 + timeout
+        expected = None
+        if self.exposure_start is not None:
+            expected = self.exposure_start + self.exposure_time + self.overhead
+        out = "E"
+        early = False
+        if self.scheduled_wait and expected is not None:
+            wake = expected - self.wake_margin
+            if timeout is not None:
+                wake = min(wake, deadline)
+            if wake > now:
+                yield From(asyncio.sleep(wake - now, loop=self.loop))
+            backlog = self.ser.read(self.ser.inWaiting())
+            if "D" in backlog:
+                out = "D"
+                early = True
+        while out != "D":
+            if timeout is None:
+                wait = 3600.0
+            else:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    cam_log.warn("Timed out waiting for exposure to finish.")
+                    self.stats.count("exposure_timeouts")
+                    raise Return(False)
+            out = yield From(self.read(1, wait))
+        self.last_wait = time.time() - t0
+        self.stats.observe("exposure_wait", self.last_wait)
+        if expected is not None:
+            self.record_timing(time.time() - expected, early)
+        raise Return(True)
+
+    @asyncio.coroutine
+    def block_read(self, npix, buf, offset):
+        """
+        same as AllSky340.block_read, except that waiting for the block and
+        backing off between re-requests don't block the loop.
+        """
+        nbytes = npix * 2
+        view = memoryview(buf)[offset:offset + nbytes]
+        block = np.frombuffer(buf, dtype=np.uint8, count=nbytes, offset=offset)
+        delay = self.retry_backoff
+        ntries = 0
+        t0 = time.time()
+        while True:
+            nread = yield From(self.read_into(view))
+            lrc_byte = yield From(self.read(1))
+            if nread < nbytes or len(lrc_byte) == 0:
+                self.stats.count("short_blocks")
+            elif block_lrc(block) == ord(lrc_byte):
+                self.stats.observe("block", time.time() - t0)
+                raise Return(True)
+            else:
+                self.stats.count("lrc_failures")
+            if ntries >= self.max_retries:
+                cam_log.error("Camera read-out of block failed after %d tries."
+                              % (ntries + 1))
+                self.stats.observe("block", time.time() - t0)
+                self.stats.count("failed_blocks")
+                raise Return(False)
+            ntries += 1
+            self.retransmits += 1
+            self.stats.count("retransmits")
+            self.retry_log.warn("Camera read-out error. Re-transmitting block "
+                                "(try #%d)...", ntries)
+            if delay > 0:
+                yield From(asyncio.sleep(delay, loop=self.loop))
+                delay *= self.backoff_factor
+            self.ser.flushInput()
+            self.command('R', 0)
+
+    @asyncio.coroutine
+    def stop_transfer(self):
+        """stop a transfer and throw away whatever was in flight"""
+        self.command('S', 0)
+        yield From(asyncio.sleep(self.ser.timeout, loop=self.loop))
+        self.ser.flushInput()
+
+    @asyncio.coroutine
+    def recover_blocks(self, npix, buf, valid):
+        """the second pass of AllSky340.recover_blocks, as a coroutine"""
+        bad = np.flatnonzero(~valid)
+        if len(bad) == 0:
+            raise Return(valid)
+        cam_log.warn("Re-transferring image to recover %d bad block(s)..."
+                     % len(bad))
+        nbytes = npix * 2
+        scratch = self.frame_buffer(npix, slot="scratch")
+        last = bad[-1]
+        yield From(self.request('X', 1))
+        for i in range(last + 1):
+            if valid[i]:
+                # a block we already have: no retries, no stats
+                nread = yield From(self.read_into(memoryview(scratch)[:nbytes]))
+                lrc_byte = yield From(self.read(1))
+                if nread < nbytes or len(lrc_byte) == 0:
+                    cam_log.warn("Lost track of transfer at block %d. "
+                                 "Stopping transfer." % i)
+                    last = -1
+                    break
+            else:
+                valid[i] = yield From(self.block_read(npix, buf, i * nbytes))
+            if i < last:
+                self.command('K', 0)
+        if last == len(valid) - 1:
+            yield From(self.request('K', 5))
+        else:
+            yield From(self.stop_transfer())
+        if valid.all():
+            cam_log.info("Recovered all bad blocks.")
+        else:
+            cam_log.error("%d block(s) could not be recovered."
+                          % np.sum(~valid))
+        raise Return(valid)
+
+    @asyncio.coroutine
+    def readout(self, cropped=False, flip=True, slot=0, mode=None,
+                callback=None):
+        """
+        transfer the last exposure from the camera.  coroutines can't be
+        generators as well, so instead of yielding a Block for each block of
+        pixels as AllSky340.readout does, callback (if given) is called with
+        it.  returns the per-block validity mask, which is also left in
+        self.last_valid.
+        """
+        mode = readout_mode(mode, cropped)
+        nrows, ncols, npix = readout_geometry(mode, self.subframe)
+        npixels = nrows * ncols
+        nblocks = npixels / npix
+        nbytes = npix * 2
+        buf = self.frame_buffer(npixels, slot)
+        image = decode_image(buf, (nrows, ncols), flip=flip)
+        flat = np.frombuffer(buf, dtype='<u2')
+        valid = np.ones(nblocks, dtype=bool)
+        self.last_valid = valid
+        self.retransmits = 0
+        t0 = time.time()
+
+        def block(i, ndone):
+            if callback is None:
+                return
+            r0 = i * npix / ncols
+            r1 = -(-(i + 1) * npix / ncols)
+            if flip:
+                rows = slice(nrows - r1, nrows - r0)
+            else:
+                rows = slice(r0, r1)
+            elapsed = time.time() - t0
+            if elapsed > 0:
+                rate = np.sum(valid[:ndone]) * nbytes / elapsed
+            else:
+                rate = 0.0
+            callback(Block(i, nblocks, bool(valid[i]), image, rows,
+                           flat[i * npix:(i + 1) * npix],
+                           float(ndone) / nblocks, elapsed, rate))
+
+        cam_log.info("Transferring image from camera....")
+        finished = False
+        try:
+            yield From(self.request('X', 1))
+            for i in range(nblocks):
+                valid[i] = yield From(self.block_read(npix, buf, i * nbytes))
+                self.command('K', 0)
+                block(i, i + 1)
+            yield From(self.read(5))
+            finished = True
+
+            if self.second_pass and not valid.all():
+                bad = ~valid
+                yield From(self.recover_blocks(npix, buf, valid))
+                for i in np.flatnonzero(bad & valid):
+                    block(i, nblocks)
+        finally:
+            if not finished:
+                # cancelled part way through
+                cam_log.warn("Image transfer abandoned. Stopping transfer.")
+                self.command('S', 0)
+                # can't yield here if the coroutine is being closed, so
+                # this sleep blocks.  it's short, and without it what's
+                # still in flight ends up in the next command's response.
+                time.sleep(self.ser.timeout)
+                self.ser.flushInput()
+
+        for i in np.flatnonzero(~valid):
+            flat[i * npix:(i + 1) * npix] = 0
+        self.last_readout_time = time.time() - t0
+        self.readout_done(mode, valid, nbytes)
+        raise Return(valid)
+
+    @asyncio.coroutine
+    def getImage(self, exptime, light=False, cropped=False,
+                 dtype="uint16", flip=True, copy=True, with_mask=False,
+                 mode=None, callback=None):
+        """
+        take an exposure and read it out, as AllSky340.getImage.  callback is
+        passed on to readout().
+        """
+        mode = readout_mode(mode, cropped)
+        t0 = time.time()
+        self.expose(exptime, light=light, mode=mode)
+        yield From(self.wait_exposure())
+        yield From(self.readout(flip=flip, mode=mode, callback=callback))
+        self.frame_done(time.time() - t0)
+        if self.auto_baud:
+            self.adapt_baudrate()
+
+        nrows, ncols, npix = readout_geometry(mode, self.subframe)
+        buf = self.frame_buffer(nrows * ncols)
+        imag = decode_image(buf, (nrows, ncols), dtype=dtype, flip=flip)
+        if copy and not imag.flags.owndata:
+            imag = imag.copy()
+        if with_mask:
+            raise Return((imag, self.last_valid))
+        raise Return(imag)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+                autoexp
+
+Auto-exposure that goes straight to the right exposure time instead of
+halving and doubling its way there.
+
+The sky level of a dark subtracted frame divided by its exposure time is the
+sky's brightness in ADU/s, which is all that's needed to work out the
+exposure time that gives the target level.  At dusk and dawn the brightness
+changes by orders of magnitude in an hour, roughly exponentially, so a
+straight line is fitted to the log of the brightness of the last few frames
+and extrapolated to the middle of the exposure being chosen.  That
+exposure is a frame or two away: AllSky340.sequence() has already started
+the next one by the time a frame is handed over.
+
+The result is snapped to the nearest step of the exposure ladder (the one
+the dark library keeps darks for) and only changed when the predicted level
+at the current exposure time is off target by more than a factor of
+tolerance, so it doesn't flap between two steps.  Frames that are mostly
+saturated or too faint to measure say little about the brightness, so for
+those the exposure time is cut or raised by max_step steps and they're left
+out of the trend.
+
+The level is the median of the good pixels, or with metering regions a
+weighted average of the medians in each one:
+
+    ae = AutoExposure(regions=[(circle(shape, 320, 240, 100), 2.0),
+                               (circle(shape, 320, 240, 230), 1.0)])
+    exp = ae.update(frame.exptime, frame.timestamp, imag, good,
+                    lead=exp + cam.transfer_time())
+"""
+
+import math
+import time
+from collections import deque
+
+import numpy as np
+
+from darklib import DEFAULT_EXPTIMES
+from framestats import FrameStats, SATURATION
+
+
+def circle(shape, x, y, r):
+    """a mask of the pixels within r of (x, y), for a metering region"""
+    yy, xx = np.ogrid[0:shape[0], 0:shape[1]]
+    return (xx - x) ** 2 + (yy - y) ** 2 <= r * r
+
+
+class AutoExposure(object):
+    def __init__(self, exptimes=DEFAULT_EXPTIMES, target=8000.0,
+                 tolerance=1.5, regions=None, history=5, memory=900.0,
+                 faint=50.0, saturated=0.5, max_step=3, max_change=4.0):
+        """
+        exptimes are the exposure times to choose from.  target is the sky
+        level in ADU to aim for, and the exposure time is only changed if
+        the level at the current one would be off by more than a factor of
+        tolerance.  regions is a list of (mask, weight) metering regions.
+        the trend is fitted to the last history frames that are no older
+        than memory seconds, and is not allowed to change the brightness by
+        more than a factor of max_change.  frames whose level is under faint
+        ADU, or with more than the fraction saturated of their pixels
+        saturated, move the exposure time max_step steps.
+        """
+        self.exptimes = sorted(exptimes)
+        self.target = target
+        self.tolerance = tolerance
+        self.regions = regions
+        self.memory = memory
+        self.faint = faint
+        self.saturated = saturated
+        self.max_step = max_step
+        self.max_change = max_change
+        # (mid-exposure time, log brightness) of recent frames
+        self.history = deque(maxlen=history)
+        self.last = None
+
+    def level(self, imag, good=None, stats=None):
+        """the sky level of a frame: a median, or weighted medians"""
+        if not self.regions:
+            if stats is None:
+                stats = FrameStats(imag, good)
+            return stats.median
+        total = 0.0
+        weights = 0.0
+        for mask, weight in self.regions:
+            if good is not None:
+                mask = mask & good
+            if not mask.any():
+                continue
+            total += weight * FrameStats(imag, mask).median
+            weights += weight
+        if weights == 0:
+            raise ValueError("No good pixels in any metering region")
+        return total / weights
+
+    def step(self, exptime):
+        """index of the ladder step nearest exptime"""
+        return min(range(len(self.exptimes)),
+                   key=lambda i: abs(math.log(self.exptimes[i] / exptime)))
+
+    def brightness(self, when):
+        """sky brightness in ADU/s expected at time when, from the trend"""
+        t, b = zip(*self.history)
+        now = t[-1]
+        latest = b[-1]
+        if len(t) < 3 or t[-1] - t[0] <= 0:
+            return math.exp(latest)
+        slope = np.polyfit(np.array(t) - now, b, 1)[0]
+        change = slope * (when - now)
+        limit = math.log(self.max_change)
+        change = max(-limit, min(limit, change))
+        return math.exp(latest + change)
+
+    def update(self, exptime, timestamp, imag, good=None, stats=None,
+               lead=0.0, now=None):
+        """
+        the exposure time to use next, given a dark subtracted frame of
+        exptime seconds started at timestamp.  lead is how long from now
+        until the exposure being chosen starts.  stats is the frame's
+        FrameStats if there is one already.
+        """
+        if now is None:
+            now = time.time()
+        while self.history and now - self.history[0][0] > self.memory:
+            self.history.popleft()
+        level = self.level(imag, good, stats)
+        if stats is None:
+            stats = FrameStats(imag, good)
+        current = self.step(exptime)
+        self.last = {"exptime": exptime, "level": level,
+                     "saturated": stats.saturated_fraction()}
+
+        if stats.saturated_fraction() > self.saturated or \
+                level >= 0.9 * SATURATION:
+            choice = max(current - self.max_step, 0)
+            self.last["reason"] = "saturated"
+        elif level < self.faint:
+            choice = min(current + self.max_step, len(self.exptimes) - 1)
+            self.last["reason"] = "faint"
+        else:
+            mid = timestamp + exptime / 2.0
+            self.history.append((mid, math.log(level / exptime)))
+            # the chosen exposure's middle, near enough
+            when = now + lead + exptime / 2.0
+            rate = self.brightness(when)
+            predicted = rate * self.exptimes[current]
+            self.last["predicted"] = predicted
+            if self.target / self.tolerance <= predicted <= \
+                    self.target * self.tolerance:
+                choice = current
+                self.last["reason"] = "on target"
+            else:
+                choice = self.step(self.target / rate)
+                self.last["reason"] = "predicted"
+        self.last["next"] = self.exptimes[choice]
+        return self.exptimes[choice]
+
+    def report(self):
+        return {"target": self.target,
+                "history": list(self.history),
+                "last": self.last}
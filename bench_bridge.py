@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+network bridge benchmark.  puts the fakecam simulator's port on a local TCP
+socket with each bridge in turn and reads frames through it with AllSky340:
+
+  - example_raw      Doc/examples/tcp_serial_redirect.py
+  - example_rfc2217  Doc/examples/rfc2217_server.py
+  - bridge_raw       camera_bridge.py
+  - bridge_rfc2217   camera_bridge.py --rfc2217
+
+and reports bytes/s of image data, frame and block latency percentiles and,
+for camera_bridge, its own counters (port reads, sends, how long data sat in
+it).  the simulator doesn't pace the link by default (--link-baud 0) so the
+bridge is what limits the transfer.  to see how each one copes with data
+trickling in at the real wire speed use --link-baud 460800 --time-scale 1.
+results are written as JSON.
+
+usage: bench_bridge.py [options]
+"""
+
+import os
+import imp
+import time
+import json
+import socket
+import optparse
+import threading
+import numpy as np
+import serial
+
+from AllSky340 import AllSky340
+from fakecam import FakeAllSky340
+from camera_bridge import CameraBridge
+from bench_readout import timed, percentiles
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "Doc", "examples")
+
+BRIDGES = ["example_raw", "example_rfc2217", "bridge_raw", "bridge_rfc2217"]
+
+
+class PtySerial(serial.Serial):
+    """
+    the simulator's pty has no modem lines, but the RFC 2217 port manager
+    reads and sets them when a client connects
+    """
+    cts = dsr = ri = cd = property(lambda self: True)
+
+    def _update_dtr_state(self):
+        pass
+
+    def _update_rts_state(self):
+        pass
+
+
+def example(name):
+    return imp.load_source(name, os.path.join(EXAMPLES, name + ".py"))
+
+
+def start_bridge(kind, ser):
+    """
+    listen on a free local port and bridge the first client to ser in a
+    background thread.  returns the URL to open, the thread and a list that
+    gets the CameraBridge, if it is one.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    bridges = []
+
+    def run():
+        sock, addr = listener.accept()
+        listener.close()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if kind == "example_raw":
+            example("tcp_serial_redirect").Redirector(ser, sock).shortcut()
+        elif kind == "example_rfc2217":
+            example("rfc2217_server").Redirector(ser, sock).shortcut()
+        else:
+            bridge = CameraBridge(ser, sock, telnet=kind == "bridge_rfc2217")
+            bridges.append(bridge)
+            bridge.run()
+
+    thread = threading.Thread(target=run, name=kind)
+    thread.daemon = True
+    thread.start()
+    if kind.endswith("rfc2217"):
+        url = "rfc2217://127.0.0.1:%d" % port
+    else:
+        url = "socket://127.0.0.1:%d" % port
+    return url, thread, bridges
+
+
+def run(kind, mode, nframes, link_baud, time_scale, exptime, seed):
+    fake = FakeAllSky340(link_baud=link_baud, time_scale=time_scale,
+                         seed=seed)
+    ser = PtySerial(fake.port, 460800, timeout=1)
+    try:
+        url, thread, bridges = start_bridge(kind, ser)
+        cam = AllSky340(port=url, baudrate=460800, timeout=1.0,
+                        pipeline=False)
+        block_times = []
+        cam.block_read = timed(cam.block_read, block_times)
+        readouts = []
+        frames = []
+        for i in range(nframes):
+            t0 = time.time()
+            imag = cam.getImage(exptime, light=True, mode=mode)
+            frames.append(time.time() - t0)
+            readouts.append(cam.last_readout_time)
+        # the bridges stop once the client has gone
+        cam.ser.close()
+        thread.join(5.0)
+    finally:
+        ser.close()
+        fake.close()
+    r = {"bridge": kind,
+         "mode": mode,
+         "frames": nframes,
+         "bytes_per_sec": imag.size * 2 / np.mean(readouts),
+         "block_latency": percentiles(block_times, 1.0),
+         "frame_latency": percentiles(frames, 1.0),
+         "client_reads": cam.ser.reads / nframes}
+    if bridges:
+        report = bridges[0].report()
+        counters = report["stats"]["counters"]
+        r["bridge_stats"] = report
+        r["port_reads"] = counters.get("port_reads", 0) / nframes
+        r["net_sends"] = counters.get("net_sends", 0) / nframes
+    return r
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-b", "--bridges", default=",".join(BRIDGES),
+                      help="comma-separated bridges (default: all)")
+    parser.add_option("-m", "--modes", default="full",
+                      help="comma-separated readout modes (default: full)")
+    parser.add_option("-n", "--frames", type=int, default=3,
+                      help="frames per configuration (default: 3)")
+    parser.add_option("--link-baud", type=int, default=0,
+                      help="pace the simulated link at this rate (default: "
+                      "0, not at all)")
+    parser.add_option("-t", "--time-scale", type=float, default=0.01,
+                      help="simulator time scale, which also scales the "
+                      "paced link's speed (default: 0.01)")
+    parser.add_option("--exptime", type=float, default=0.01,
+                      help="exposure time in seconds (default: 0.01)")
+    parser.add_option("-o", "--output", default="bench_bridge.json",
+                      help="results file (default: bench_bridge.json)")
+    parser.add_option("--seed", type=int, default=1)
+    opts, args = parser.parse_args()
+
+    results = []
+    for kind in opts.bridges.split(","):
+        for mode in opts.modes.split(","):
+            r = run(kind, mode, opts.frames, opts.link_baud,
+                    opts.time_scale, opts.exptime, opts.seed)
+            results.append(r)
+            line = ("%-16s %-7s %9.0f B/s  block p50 %6.2f ms p99 %6.2f ms  "
+                    "frame %6.2f s  %5.0f client reads/frame" %
+                    (kind, mode, r["bytes_per_sec"],
+                     r["block_latency"]["p50"] * 1e3,
+                     r["block_latency"]["p99"] * 1e3,
+                     r["frame_latency"]["p50"], r["client_reads"]))
+            if "port_reads" in r:
+                line += "  %5.0f port reads, %5.0f sends/frame" % (
+                    r["port_reads"], r["net_sends"])
+            print(line)
+
+    out = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "options": vars(opts),
+           "results": results}
+    f = open(opts.output, "w")
+    json.dump(out, f, indent=2, sort_keys=True)
+    f.close()
+    print("Results written to %s" % opts.output)
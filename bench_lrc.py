@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+micro-benchmark for the per-block LRC check and the command checksum.
+compares the old byte-at-a-time python loops with block_lrc() and the
+table-driven checksum() in AllSky340.py.
+
+usage: bench_lrc.py [nloops]
+"""
+
+import sys
+import os
+import timeit
+
+from AllSky340 import block_lrc, checksum
+
+# 4096 pixels * 2 bytes in 1x1 binning
+BLOCK_BYTES = 8192
+NBLOCKS = 75
+
+
+def old_lrc(block):
+    lrc = 0
+    for b in block:
+        lrc ^= ord(b)
+    return lrc
+
+
+def old_checksum(c):
+    inv = ~ord(c[0]) & 0xFF
+    mask = ~(1 << 7)
+    checksum = inv & mask
+    if len(c) > 1:
+        for i in range(1, len(c)):
+            inv = ~ord(c[i]) & 0xFF
+            xor = checksum ^ inv
+            checksum = xor & mask
+    return checksum
+
+
+def best_of(fn, number, repeat=5):
+    """best time per call in seconds"""
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        nloops = int(sys.argv[1])
+    else:
+        nloops = 200
+
+    block = os.urandom(BLOCK_BYTES)
+    assert old_lrc(block) == block_lrc(block)
+    cmd = "T" + os.urandom(5)
+    assert old_checksum(cmd) == checksum(cmd)
+
+    t_old = best_of(lambda: old_lrc(block), max(nloops / 20, 1))
+    t_new = best_of(lambda: block_lrc(block), nloops)
+    print("block LRC (%d bytes):" % BLOCK_BYTES)
+    print("  python loop  %10.2f us/block  %8.2f ms/frame" %
+          (t_old * 1e6, t_old * NBLOCKS * 1e3))
+    print("  block_lrc    %10.2f us/block  %8.2f ms/frame" %
+          (t_new * 1e6, t_new * NBLOCKS * 1e3))
+    print("  speedup      %10.1fx" % (t_old / t_new))
+
+    t_old = best_of(lambda: old_checksum(cmd), nloops * 50)
+    t_new = best_of(lambda: checksum(cmd), nloops * 50)
+    print("command checksum (%d bytes):" % len(cmd))
+    print("  python loop  %10.2f us/cmd" % (t_old * 1e6))
+    print("  table        %10.2f us/cmd" % (t_new * 1e6))
+    print("  speedup      %10.1fx" % (t_old / t_new))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+readout throughput benchmark.  drives AllSky340.set_baudrate, getImage and
+(through getImage) block_read against the fakecam simulator for each
+combination of baudrate, byte error rate and readout mode, and reports:
+
+  - effective throughput in bytes/s of image data
+  - per-block latency percentiles (each block_read call, retries included)
+  - retransmitted blocks and the time they cost
+  - end-to-end frame latency (getImage call, exposure included)
+  - how long set_baudrate took
+
+times are in real (unscaled) seconds: the simulator runs the link and the
+exposures time_scale times faster and the measurements are scaled back.
+host-side overheads get scaled up along with them, so use --time-scale 1
+for the most faithful numbers.  results are written as JSON.  --baseline
+compares bytes/s against an earlier results file and exits non-zero if
+anything got slower by more than --tolerance.
+
+usage: bench_readout.py [options]
+"""
+
+import sys
+import time
+import json
+import optparse
+import numpy as np
+
+from AllSky340 import AllSky340, BAUDRATES
+from fakecam import FakeAllSky340
+
+
+def timed(fn, times):
+    """wrap fn so the duration of every call is appended to times"""
+    def wrapper(*args, **kwargs):
+        t0 = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            times.append(time.time() - t0)
+    return wrapper
+
+
+def percentiles(values, scale):
+    if len(values) == 0:
+        return {}
+    values = np.asarray(values) / scale
+    return {"p50": float(np.percentile(values, 50)),
+            "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)),
+            "max": float(values.max())}
+
+
+def run(baud, error_rate, mode, nframes, time_scale, exptime, seed):
+    fake = FakeAllSky340(baudrate=460800, error_rate=error_rate,
+                         time_scale=time_scale, seed=seed)
+    try:
+        cam = AllSky340(port=fake.port, baudrate=460800,
+                        timeout=max(0.1, 0.5 * time_scale))
+        t0 = time.time()
+        ok = cam.set_baudrate(baud)
+        t_baud = (time.time() - t0) / time_scale
+        if not ok:
+            return {"baudrate": baud, "error": "set_baudrate failed"}
+        if mode == "subframe":
+            cam.set_subframe(256, 176, 127)
+
+        block_times = []
+        cam.block_read = timed(cam.block_read, block_times)
+        frame_times = []
+        nbad = 0
+        retransmits0 = fake.nretransmits
+        for i in range(nframes):
+            t0 = time.time()
+            imag, valid = cam.getImage(exptime, light=True, mode=mode,
+                                       with_mask=True)
+            frame_times.append(time.time() - t0)
+            nbad += np.sum(~valid)
+        cam.ser.close()
+    finally:
+        fake.close()
+
+    retransmits = fake.nretransmits - retransmits0
+    # the quickest blocks are the ones that came over first time.  use them
+    # as the cost of sending a block again.
+    block_time = np.percentile(block_times, 10) / time_scale
+    readout = (np.array(frame_times) / time_scale) - exptime
+    nbytes = imag.size * 2
+    return {"baudrate": baud,
+            "error_rate": error_rate,
+            "mode": mode,
+            "frames": nframes,
+            "bytes_per_sec": nbytes / np.mean(readout),
+            "wire_bytes_per_sec": baud / 10.0,
+            "block_latency": percentiles(block_times, time_scale),
+            "retransmits": retransmits,
+            "retransmit_time": retransmits * block_time / nframes,
+            "bad_blocks": int(nbad),
+            "frame_latency": percentiles(frame_times, time_scale),
+            "set_baudrate_time": t_baud}
+
+
+def compare(results, baseline, tolerance):
+    """list of (key, old, new) for configurations that got slower"""
+    def key(r):
+        return (r["baudrate"], r.get("error_rate"), r.get("mode"))
+    old = dict((key(r), r) for r in baseline["results"]
+               if "bytes_per_sec" in r)
+    slower = []
+    for r in results:
+        o = old.get(key(r))
+        if o is None or "bytes_per_sec" not in r:
+            continue
+        if r["bytes_per_sec"] < o["bytes_per_sec"] * (1.0 - tolerance):
+            slower.append((key(r), o["bytes_per_sec"], r["bytes_per_sec"]))
+    return slower
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-b", "--bauds", default="115200,230400,460800",
+                      help="comma-separated baudrates, or 'all'")
+    parser.add_option("-e", "--errors", default="0,1e-5,1e-4",
+                      help="comma-separated per-byte error rates")
+    parser.add_option("-m", "--modes", default="full,cropped",
+                      help="comma-separated readout modes (full, cropped, "
+                      "bin2x2, subframe)")
+    parser.add_option("-n", "--frames", type=int, default=3,
+                      help="frames per configuration (default: 3)")
+    parser.add_option("-t", "--time-scale", type=float, default=0.1,
+                      help="simulator time scale (default: 0.1)")
+    parser.add_option("--exptime", type=float, default=0.01,
+                      help="exposure time in seconds (default: 0.01)")
+    parser.add_option("-o", "--output", default="bench_readout.json",
+                      help="results file (default: bench_readout.json)")
+    parser.add_option("--baseline", default=None,
+                      help="earlier results file to compare against")
+    parser.add_option("--tolerance", type=float, default=0.1,
+                      help="allowed fractional slowdown (default: 0.1)")
+    parser.add_option("--seed", type=int, default=1)
+    opts, args = parser.parse_args()
+
+    if opts.bauds == "all":
+        bauds = sorted(BAUDRATES)
+    else:
+        bauds = [int(b) for b in opts.bauds.split(",")]
+    errors = [float(e) for e in opts.errors.split(",")]
+    modes = opts.modes.split(",")
+
+    results = []
+    for baud in bauds:
+        for error_rate in errors:
+            for mode in modes:
+                r = run(baud, error_rate, mode, opts.frames,
+                        opts.time_scale, opts.exptime, opts.seed)
+                results.append(r)
+                if "error" in r:
+                    print("%6d %8g %-7s  %s" % (baud, error_rate, mode,
+                                                r["error"]))
+                    continue
+                print("%6d %8g %-7s %9.0f B/s  block p50 %6.1f ms "
+                      "p99 %6.1f ms  %3d retransmits (%5.2f s/frame)  "
+                      "frame %6.2f s" %
+                      (baud, error_rate, mode, r["bytes_per_sec"],
+                       r["block_latency"]["p50"] * 1e3,
+                       r["block_latency"]["p99"] * 1e3, r["retransmits"],
+                       r["retransmit_time"], r["frame_latency"]["p50"]))
+
+    out = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "options": vars(opts),
+           "results": results}
+    f = open(opts.output, "w")
+    json.dump(out, f, indent=2, sort_keys=True)
+    f.close()
+    print("Results written to %s" % opts.output)
+
+    if opts.baseline:
+        f = open(opts.baseline)
+        baseline = json.load(f)
+        f.close()
+        slower = compare(results, baseline, opts.tolerance)
+        for key, old, new in slower:
+            print("REGRESSION %s: %.0f -> %.0f B/s" % (key, old, new))
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+startup benchmark.  runs each entry point script as it is, in a fresh
+interpreter, against a fakecam simulator and times:
+
+  - to_camera: from launching the script to its first byte to the camera,
+    which is everything it imports and sets up before opening the camera
+  - exit: until the script exits, for the ones that do.  the ones that run
+    until stopped (skycam.py, skycamd.py) are stopped a few seconds after
+    they've opened the camera.
+
+the camera port is passed in with SKYCAM_PORT (or -p for skycamd.py), and
+the daemon and frame sockets are put in a temporary directory.  one more run
+of each under python -v lists which of the heavy packages (numpy, astropy,
+matplotlib, scipy) had been imported by the time the camera was opened.
+results are written as JSON; with --budget it exits non-zero if any entry
+point takes longer than that to get to the camera.
+
+usage: bench_startup.py [options]
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import shutil
+import tempfile
+import optparse
+import threading
+import subprocess
+
+from fakecam import FakeAllSky340
+
+HEAVY = ["numpy", "astropy", "matplotlib", "scipy"]
+
+# name, command line (%(port)s is the camera's port) and whether it runs
+# until it's stopped
+ENTRY_POINTS = [
+    ("AllSky340.py ping", ["AllSky340.py", "ping"], False),
+    ("test_comm.py", ["test_comm.py"], False),
+    ("skycamd.py", ["skycamd.py", "-p", "%(port)s"], True),
+    ("skycam.py", ["skycam.py"], True),
+]
+
+HEAVY_IMPORT = re.compile(r"^import (%s)\b" % "|".join(HEAVY))
+
+
+def read_lines(f, lines):
+    """collect (time, line) from f until it's closed"""
+    for line in iter(f.readline, ""):
+        lines.append((time.time(), line))
+
+
+def run(entry, verbose=False, linger=3.0, timeout=60.0):
+    """
+    run one entry point against a new simulator.  with verbose set it runs
+    under python -v and records which heavy packages were imported before
+    the camera was opened.
+    """
+    name, argv, forever = entry
+    fake = FakeAllSky340()
+    tmp = tempfile.mkdtemp(prefix="bench_startup")
+    env = dict(os.environ,
+               SKYCAM_PORT=fake.port,
+               SKYCAMD_SOCKET=os.path.join(tmp, "skycamd.sock"),
+               SKYCAM_FRAMES=os.path.join(tmp, "frames.sock"))
+    cmd = [sys.executable]
+    if verbose:
+        cmd.append("-v")
+    cmd += [arg % {"port": fake.port} for arg in argv]
+    out = []
+    err = []
+    stopped = False
+    try:
+        t0 = time.time()
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        readers = [threading.Thread(target=read_lines, args=(f, lines))
+                   for f, lines in ((proc.stdout, out), (proc.stderr, err))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        while proc.poll() is None:
+            now = time.time()
+            opened = fake.first_read
+            if now - t0 > timeout or \
+                    forever and opened is not None and now - opened > linger:
+                proc.terminate()
+                proc.wait()
+                stopped = True
+                break
+            time.sleep(0.01)
+        ended = time.time()
+        for reader in readers:
+            reader.join(1.0)
+    finally:
+        fake.close()
+        shutil.rmtree(tmp, True)
+
+    r = {"name": name, "command": " ".join(cmd[1:]), "returncode":
+         proc.returncode, "stopped": stopped, "to_camera": None, "exit": None}
+    if fake.first_read is not None:
+        r["to_camera"] = fake.first_read - t0
+    if not stopped:
+        r["exit"] = ended - t0
+        if proc.returncode != 0:
+            r["error"] = "".join(line for t, line in err[-1:]).strip()
+    if verbose:
+        opened = fake.first_read or ended
+        heavy = []
+        for t, line in err:
+            m = HEAVY_IMPORT.match(line)
+            if m and t < opened and m.group(1) not in heavy:
+                heavy.append(m.group(1))
+        r["heavy"] = heavy
+    return r
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--repeat", type=int, default=3,
+                      help="runs per entry point, best is kept (default: 3)")
+    parser.add_option("-o", "--output", default="bench_startup.json",
+                      help="results file (default: bench_startup.json)")
+    parser.add_option("--budget", type=float, default=None,
+                      help="maximum seconds from start to an open camera")
+    parser.add_option("--linger", type=float, default=3.0,
+                      help="seconds to leave scripts that run until stopped "
+                      "going after they open the camera (default: 3)")
+    opts, args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for entry in ENTRY_POINTS:
+        runs = [run(entry, linger=opts.linger) for i in range(opts.repeat)]
+        opened = [r for r in runs if r["to_camera"] is not None]
+        if opened:
+            r = min(opened, key=lambda r: r["to_camera"])
+        else:
+            r = runs[0]
+        r["heavy"] = run(entry, verbose=True, linger=opts.linger)["heavy"]
+        results.append(r)
+
+        line = "%-18s" % r["name"]
+        if r["to_camera"] is None:
+            line += "  never opened the camera"
+        else:
+            line += "  to camera %6.3f s" % r["to_camera"]
+        if r["stopped"]:
+            line += "  (stopped)        "
+        else:
+            line += "  exit %6.3f s rc %d" % (r["exit"], r["returncode"])
+        line += "  heavy: %s" % (", ".join(r["heavy"]) or "-")
+        print(line)
+        if "error" in r:
+            print("%-18s  %s" % ("", r["error"]))
+
+    out = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "python": sys.version.split()[0],
+           "results": results}
+    f = open(opts.output, "w")
+    json.dump(out, f, indent=2, sort_keys=True)
+    f.close()
+    print("Results written to %s" % opts.output)
+
+    if opts.budget is not None:
+        over = [r["name"] for r in results
+                if r["to_camera"] is None or r["to_camera"] > opts.budget]
+        for name in over:
+            print("OVER BUDGET: %s" % name)
+        if over:
+            sys.exit(1)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+                bufserial
+
+A buffered transport for a pyserial port.  BufferedSerial wraps an open
+serial.Serial and reads from it in as large chunks as are available into a
+ring buffer, handing bytes out from there.  On top of the usual read(),
+readinto(), write(), flushInput() and inWaiting() it adds the primitives the
+camera protocol needs:
+
+    read_exact(n, into=None)   n bytes, optionally straight into a buffer
+    ensure(n)                  get n bytes into the buffer in as few reads
+                               as possible, to be read out afterwards
+    read_until(terminator)     everything up to and including terminator
+    drain_trailer(n)           throw away n bytes
+
+Reads of direct bytes or more (a block of pixels) only go through the ring
+buffer for whatever is already in it; the rest is read from the port
+straight into the caller's buffer, so the pixels aren't copied twice.  The
+small reads (acks, checksums, the trailer) are served from the buffer.
+
+Everything else (baudrate, timeout, fileno(), close(), ...) is passed through
+to the wrapped port, so it can stand in for one.  The syscalls counter counts
+the calls made on the port (reads, writes and inWaiting checks) and bytes_in
+and bytes_out the traffic, so it's easy to see how many reads a frame took.
+
+This grew out of the EnhancedSerial readline example from pyserial (see
+Doc/examples/enhancedserial.py).
+"""
+
+
+class BufferedSerial(object):
+    def __init__(self, ser, size=65536, direct=1024):
+        # set through __dict__ so __setattr__ doesn't try to pass them on
+        self.__dict__.update(serial=ser,
+                             buf=bytearray(size),
+                             size=size,
+                             direct=min(direct, size),
+                             head=0,
+                             count=0,
+                             syscalls=0,
+                             reads=0,
+                             bytes_in=0,
+                             bytes_out=0)
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+    def __setattr__(self, name, value):
+        # port settings like baudrate and timeout go to the port
+        if name in self.__dict__:
+            self.__dict__[name] = value
+        else:
+            setattr(self.serial, name, value)
+
+    def stats(self):
+        return {"syscalls": self.syscalls,
+                "reads": self.reads,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "buffered": self.count}
+
+    def reset_stats(self):
+        self.syscalls = self.reads = self.bytes_in = self.bytes_out = 0
+
+    def fill(self, want):
+        """
+        one read from the port into the free space of the ring buffer: at
+        least want bytes (waiting up to the port timeout for them) or however
+        many have already arrived, whichever is more, as long as they fit
+        without wrapping.  returns the number of bytes read.
+        """
+        if self.count == 0:
+            self.head = 0
+        tail = (self.head + self.count) % self.size
+        if tail >= self.head and self.count < self.size:
+            space = self.size - tail
+        else:
+            space = self.head - tail
+        if space == 0:
+            return 0
+        self.syscalls += 1
+        waiting = self.serial.inWaiting()
+        n = min(space, max(want, waiting))
+        if n == 0:
+            return 0
+        self.syscalls += 1
+        self.reads += 1
+        nread = self.serial.readinto(memoryview(self.buf)[tail:tail + n])
+        self.count += nread
+        self.bytes_in += nread
+        return nread
+
+    def ensure(self, n):
+        """
+        read until at least n bytes (no more than the buffer size) are
+        buffered or the port times out.  returns how many are buffered.
+        """
+        while self.count < n and self.fill(n - self.count):
+            pass
+        return self.count
+
+    def take(self, view):
+        """copy as much of the buffered data into view as fits.  no syscalls."""
+        n = min(len(view), self.count)
+        first = min(n, self.size - self.head)
+        view[:first] = self.buf[self.head:self.head + first]
+        if n > first:
+            view[first:n] = self.buf[:n - first]
+        self.head = (self.head + n) % self.size
+        self.count -= n
+        return n
+
+    def find(self, terminator):
+        """offset of terminator in the buffered data, or -1"""
+        data = self.peek()
+        return data.find(terminator)
+
+    def peek(self):
+        """the buffered data, as a string, without consuming it"""
+        end = self.head + self.count
+        if end <= self.size:
+            return str(self.buf[self.head:end])
+        return str(self.buf[self.head:]) + str(self.buf[:end - self.size])
+
+    def readinto(self, view):
+        """
+        fill view, from the buffer first and then from the port.  returns the
+        number of bytes read, which is short only if the port timed out.
+        """
+        n = len(view)
+        got = self.take(view)
+        while got < n:
+            if n - got >= self.direct:
+                # the buffer's empty and this is big, read it straight in
+                self.syscalls += 1
+                self.reads += 1
+                nread = self.serial.readinto(view[got:])
+                self.bytes_in += nread
+                got += nread
+                break
+            if not self.fill(n - got):
+                break
+            got += self.take(view[got:])
+        return got
+
+    def read_exact(self, n, into=None):
+        """
+        read n bytes.  returns them as a string, or if into (a writable
+        buffer of at least n bytes) is given reads them into that and returns
+        the number read.  short only if the port timed out.
+        """
+        if into is not None:
+            return self.readinto(memoryview(into)[:n])
+        buf = bytearray(n)
+        got = self.readinto(memoryview(buf))
+        return str(buf[:got])
+
+    def read(self, size=1):
+        return self.read_exact(size)
+
+    def read_until(self, terminator, maxsize=None):
+        """
+        read up to and including terminator.  gives up and returns what was
+        read if a read from the port times out or maxsize bytes have been
+        read without seeing it.
+        """
+        while True:
+            i = self.find(terminator)
+            if i >= 0:
+                return self.read_exact(i + len(terminator))
+            if maxsize is not None and self.count >= maxsize:
+                return self.read_exact(maxsize)
+            if self.count == self.size or not self.fill(1):
+                return self.read_exact(self.count)
+
+    def drain_trailer(self, n):
+        """read and throw away n bytes.  returns how many there were."""
+        dropped = 0
+        while dropped < n:
+            if self.count == 0 and not self.fill(n - dropped):
+                break
+            k = min(self.count, n - dropped)
+            self.head = (self.head + k) % self.size
+            self.count -= k
+            dropped += k
+        return dropped
+
+    def inWaiting(self):
+        self.syscalls += 1
+        return self.count + self.serial.inWaiting()
+
+    def flushInput(self):
+        self.head = 0
+        self.count = 0
+        self.syscalls += 1
+        self.serial.flushInput()
+
+    def write(self, data):
+        self.syscalls += 1
+        n = self.serial.write(data)
+        self.bytes_out += len(data)
+        return n
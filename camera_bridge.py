@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+                camera_bridge
+
+Put the camera's serial port on the network, for AllSky340 to open as
+socket://host:port or, with --rfc2217, rfc2217://host:port (which lets the
+client change the baudrate).
+
+The redirectors in Doc/examples (tcp_serial_redirect.py, rfc2217_server.py)
+are meant for terminals: a thread reads one byte, then whatever else is
+waiting, escapes it a byte at a time and sends it.  An image transfer is
+75 blocks of 8 KB coming as fast as the port allows, so this bridge is
+built for that instead:
+
+  - one thread and select() for both directions
+  - the port is read straight into a preallocated buffer, and reads keep
+    going until a block's worth has come in or the port goes quiet for a
+    few milliseconds, so a block goes out in one or two sends
+  - the data is sent from that buffer without copying it, unless telnet
+    IAC bytes (0xff) have to be escaped, which is done to the whole chunk
+    at once
+
+Acks and commands from the client are passed straight to the port.  The
+bridge counts bytes, reads and sends each way and times how long data sits
+in it; report() has the summary and --stats writes it out as JSON after
+every connection.  One client is served at a time.
+
+usage: camera_bridge.py [options]
+"""
+
+import io
+import time
+import select
+import socket
+import serial
+import serial.rfc2217
+
+from camstats import Stats, dump_json
+from camlog import cam_log, setup_logging
+
+# the biggest block the camera sends, with its LRC byte
+BLOCK_BYTES = 4096 * 2 + 1
+
+IAC = "\xff"
+
+# how often RFC 2217 clients are told about the modem lines, as the
+# redirector in Doc/examples does it
+MODEM_POLL = 1.0
+
+
+def default_gap(baudrate):
+    """3 ms plus 20 character times at baudrate, see CameraBridge"""
+    return 0.003 + 20 * 10.0 / baudrate
+
+
+class CameraBridge(object):
+    def __init__(self, ser, sock, telnet=False, bufsize=65536,
+                 batch=BLOCK_BYTES, gap=None):
+        """
+        ser is an open serial port and sock a connected socket.  with telnet
+        set the socket side speaks RFC 2217.  data from the port is
+        forwarded once batch bytes have been read or nothing more has come
+        in for gap seconds.  USB serial adapters hand data over in packets
+        a millisecond or more apart, so the default is 3 ms plus 20
+        character times at the port's baudrate, worked out again whenever
+        an RFC 2217 client changes the baudrate.  gap=0 forwards whatever
+        each read gets.
+        """
+        self.ser = ser
+        self.sock = sock
+        self.fd = ser.fileno()
+        # readinto() on the port's file descriptor fills our buffer directly
+        self.port = io.FileIO(self.fd, "r", closefd=False)
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.netbuf = bytearray(4096)
+        self.netview = memoryview(self.netbuf)
+        self.batch = min(batch, bufsize)
+        self.auto_gap = gap is None
+        if gap is None:
+            gap = default_gap(ser.baudrate)
+        self.gap = gap
+        self.stats = Stats()
+        self.bytes_to_net = 0
+        self.bytes_to_port = 0
+        self.busy = 0.0
+        self.started = None
+        self.alive = False
+        self.rfc2217 = None
+        if telnet:
+            self.rfc2217 = serial.rfc2217.PortManager(ser, self)
+
+    def write(self, data):
+        """telnet replies from the RFC 2217 port manager"""
+        self.sock.sendall(data)
+
+    def run(self):
+        """forward in both directions until the client goes away"""
+        self.alive = True
+        self.started = time.time()
+        next_poll = self.started
+        try:
+            while self.alive:
+                timeout = 1.0
+                if self.rfc2217 is not None:
+                    now = time.time()
+                    if now >= next_poll:
+                        self.rfc2217.check_modem_lines()
+                        next_poll = now + MODEM_POLL
+                    timeout = max(0.0, next_poll - now)
+                r, w, x = select.select([self.fd, self.sock], [], [], timeout)
+                if self.fd in r:
+                    self.from_camera()
+                if self.sock in r and not self.from_network():
+                    break
+        except socket.error, err:
+            cam_log.info("Bridge client went away: %s" % err)
+        self.alive = False
+
+    def read_port(self, offset):
+        n = self.port.readinto(self.view[offset:])
+        if n is None:
+            # nothing there after all on a non-blocking port
+            return 0
+        self.stats.count("port_reads")
+        return n
+
+    def from_camera(self):
+        t0 = time.time()
+        n = self.read_port(0)
+        # the rest of a block is probably on its way.  wait for it unless
+        # the port goes quiet.
+        while 0 < n < self.batch and self.gap > 0:
+            if not select.select([self.fd], [], [], self.gap)[0]:
+                break
+            m = self.read_port(n)
+            if m == 0:
+                break
+            n += m
+        if n == 0:
+            return
+        data = self.view[:n]
+        if self.rfc2217 is not None and self.buf.find(IAC, 0, n) >= 0:
+            data = data.tobytes().replace(IAC, IAC + IAC)
+            self.stats.count("escaped_chunks")
+        self.sock.sendall(data)
+        dt = time.time() - t0
+        self.busy += dt
+        self.bytes_to_net += n
+        self.stats.count("net_sends")
+        self.stats.observe("camera_to_net", dt)
+
+    def from_network(self):
+        t0 = time.time()
+        n = self.sock.recv_into(self.netbuf)
+        if n == 0:
+            return False
+        data = self.netview[:n]
+        if self.rfc2217 is not None:
+            # the client's side is mostly block acks, a few bytes at a time
+            baudrate = self.ser.baudrate
+            data = serial.to_bytes(self.rfc2217.filter(data.tobytes()))
+            if self.ser.baudrate != baudrate:
+                self.baudrate_changed()
+        if len(data):
+            self.ser.write(data)
+            self.bytes_to_port += len(data)
+        self.stats.count("net_reads")
+        self.stats.observe("net_to_camera", time.time() - t0)
+        return True
+
+    def baudrate_changed(self):
+        """the client has changed the port's baudrate"""
+        if self.auto_gap:
+            self.gap = default_gap(self.ser.baudrate)
+        cam_log.info("Bridge port now at %d baud" % self.ser.baudrate)
+
+    def stop(self):
+        self.alive = False
+
+    def report(self):
+        """counters, latencies and throughput as a dict for JSON"""
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = time.time() - self.started
+        rate = 0.0
+        if self.busy > 0:
+            rate = self.bytes_to_net / self.busy
+        return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "baudrate": self.ser.baudrate,
+                "telnet": self.rfc2217 is not None,
+                "elapsed": elapsed,
+                "bytes_to_net": self.bytes_to_net,
+                "bytes_to_port": self.bytes_to_port,
+                "busy": self.busy,
+                "bytes_per_sec": rate,
+                "stats": self.stats.as_dict()}
+
+
+def serve(ser, address, telnet=False, stats_file=None, **kwargs):
+    """accept clients on address one at a time and bridge each to ser"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(1)
+    cam_log.info("Bridging %s to %s:%d" % (ser.port, address[0] or "*",
+                                          address[1]))
+    try:
+        while True:
+            sock, addr = listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            cam_log.info("Bridge client connected from %s:%d" % addr)
+            ser.flushInput()
+            bridge = CameraBridge(ser, sock, telnet=telnet, **kwargs)
+            try:
+                bridge.run()
+            finally:
+                sock.close()
+            report = bridge.report()
+            cam_log.info("Bridge client %s:%d disconnected. %d bytes out at "
+                         "%.0f B/s, %d in." %
+                         (addr[0], addr[1], report["bytes_to_net"],
+                          report["bytes_per_sec"], report["bytes_to_port"]))
+            if stats_file:
+                dump_json(report, stats_file)
+    finally:
+        listener.close()
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option("-p", "--port", default="/dev/ttyUSB0",
+                      help="serial port (default: /dev/ttyUSB0)")
+    parser.add_option("-b", "--baudrate", type=int, default=460800)
+    parser.add_option("-H", "--host", default="",
+                      help="address to listen on (default: all)")
+    parser.add_option("-P", "--tcp-port", type=int, default=7000,
+                      help="TCP port to listen on (default: 7000)")
+    parser.add_option("--rfc2217", action="store_true", default=False,
+                      help="speak RFC 2217 instead of raw TCP")
+    parser.add_option("--gap", type=float, default=None,
+                      help="forward data from the port once it's been quiet "
+                      "this long, in seconds (default: 0.003 plus 20 "
+                      "character times)")
+    parser.add_option("--stats", default=None,
+                      help="write each connection's stats here as JSON")
+    opts, args = parser.parse_args()
+
+    setup_logging()
+    ser = serial.Serial(opts.port, opts.baudrate, timeout=0)
+    try:
+        serve(ser, (opts.host, opts.tcp_port), telnet=opts.rfc2217,
+              stats_file=opts.stats, gap=opts.gap)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ser.close()
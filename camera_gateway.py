@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+"""
+                camera_gateway
+
+Serve several cameras' serial ports on the network from one process and one
+thread, one TCP port per camera, for AllSky340 to open as socket://host:port
+or, with --rfc2217, rfc2217://host:port.  It's the design of
+Doc/examples/port_publisher.py (a Forwarder per port driven by one event
+loop) cut down to what the cameras need and tuned for image transfers the
+way camera_bridge.py is:
+
+  - the event loop uses epoll (poll where there's no epoll), and each port
+    only changes what it's registered for when that changes, rather than
+    every fd going into a fresh select() call each time round
+  - each camera has its own preallocated buffers.  data from the port is
+    read into one and sent from it without being copied
+  - data from the port is held back until a block's worth has come in or
+    the port has gone quiet for a few milliseconds, so a block goes out in
+    one or two sends.  the wait is part of the loop's timeout, so it holds
+    up nobody else
+  - with --rfc2217, telnet replies are queued and go out first.  port data
+    still goes straight from the buffer up to the first IAC byte (0xff),
+    and only the rest of that chunk is copied to escape them
+
+A port that can't keep up with its client stops being read, so flow control
+pushes back on that camera alone.  Only one client per camera is served at a
+time; others are turned away.  A serial port that goes away is closed and
+retried every few seconds.  report() has per-camera counters, latencies and
+throughput, and --stats writes it out as JSON every --stats-interval seconds.
+
+usage: camera_gateway.py [options] device:tcp_port[:baudrate] ...
+"""
+
+import io
+import os
+import math
+import time
+import errno
+import select
+import socket
+import serial
+import serial.rfc2217
+
+from camstats import Stats, dump_json
+from camlog import cam_log, setup_logging
+from camera_bridge import BLOCK_BYTES, IAC, MODEM_POLL, default_gap
+
+READ = select.POLLIN | select.POLLPRI
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+class Poller(object):
+    """
+    epoll where we have it, poll otherwise.  each fd has a handler that's
+    called with the events and the time.  timeouts are in seconds.
+    """
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.scale = 1.0
+        else:
+            self.poller = select.poll()
+            self.scale = 1000.0
+        self.masks = {}
+        self.handlers = {}
+
+    def set(self, fd, mask, handler):
+        """watch fd for the events in mask"""
+        old = self.masks.get(fd)
+        self.handlers[fd] = handler
+        if old == mask:
+            return
+        if old is None:
+            self.poller.register(fd, mask)
+        else:
+            self.poller.modify(fd, mask)
+        self.masks[fd] = mask
+
+    def forget(self, fd):
+        """stop watching fd.  call this before closing it."""
+        if fd in self.masks:
+            self.poller.unregister(fd)
+            del self.masks[fd]
+            del self.handlers[fd]
+
+    def poll(self, timeout):
+        """wait for events and pass them to the handlers"""
+        if self.scale != 1.0:
+            timeout = int(math.ceil(timeout * self.scale))
+        try:
+            events = self.poller.poll(timeout)
+        except (IOError, select.error), err:
+            if err.args[0] == errno.EINTR:
+                return 0
+            raise
+        now = time.time()
+        for fd, event in events:
+            # an earlier handler may have closed it
+            handler = self.handlers.get(fd)
+            if handler is not None:
+                handler(event, now)
+        return len(events)
+
+
+class CameraPort(object):
+    def __init__(self, poller, device, tcp_port, baudrate=460800,
+                 telnet=False, host="", bufsize=65536, batch=BLOCK_BYTES,
+                 gap=None):
+        """
+        device is the camera's serial port, served on tcp_port.  with telnet
+        set clients speak RFC 2217.  see camera_bridge.CameraBridge for
+        batch and gap.
+        """
+        self.poller = poller
+        self.device = device
+        self.tcp_port = tcp_port
+        self.baudrate = baudrate
+        self.telnet = telnet
+        self.host = host
+        # port to network.  buf[start:end] is waiting to go out.
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+        # network to port
+        self.netbuf = bytearray(4096)
+        self.netview = memoryview(self.netbuf)
+        self.netstart = self.netend = 0
+        # telnet replies, which go out ahead of buf
+        self.outq = ""
+        # the escaped end of a chunk from buf, and how much of it is sent
+        self.escaped = ""
+        self.escaped_sent = 0
+        self.batch = min(batch, bufsize)
+        self.auto_gap = gap is None
+        if gap is None:
+            gap = default_gap(baudrate)
+        self.gap = gap
+        # when RFC 2217 clients are next told about the modem lines
+        self.modem_at = 0.0
+        # when what's in buf goes out even if it's short of a batch, and
+        # when the first of it came in
+        self.flush_at = None
+        self.first_byte = None
+        self.ser = None
+        self.port_in = None
+        self.settings = None
+        self.retry_at = 0.0
+        self.server = None
+        self.sock = None
+        self.rfc2217 = None
+        self.stats = Stats()
+        self.bytes_to_net = 0
+        self.bytes_to_port = 0
+        self.busy = 0.0
+        self.clients = 0
+        self.last_report = (time.time(), 0)
+
+    def name(self):
+        return "%s:%d" % (self.device, self.tcp_port)
+
+    def open(self):
+        """open the serial port, if it's there, and start listening"""
+        self.open_serial(time.time())
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.setblocking(0)
+        self.server.bind((self.host, self.tcp_port))
+        self.server.listen(1)
+        self.poller.set(self.server.fileno(), READ, self.on_server)
+
+    def close(self):
+        self.disconnect()
+        self.close_serial()
+        if self.server is not None:
+            self.poller.forget(self.server.fileno())
+            self.server.close()
+            self.server = None
+
+    def tick(self, now):
+        """
+        called from the event loop every time round: sends anything that's
+        been held back long enough, keeps RFC 2217 clients up to date with
+        the modem lines and retries opening the port
+        """
+        if self.flush_at is not None and now >= self.flush_at:
+            self.flush_at = None
+            self.flush(now)
+        if self.rfc2217 is not None and now >= self.modem_at:
+            self.modem_at = now + MODEM_POLL
+            try:
+                self.rfc2217.check_modem_lines()
+            except (IOError, OSError, serial.SerialException), err:
+                self.serial_error(err)
+        if self.ser is None and now >= self.retry_at:
+            self.open_serial(now)
+
+    def open_serial(self, now):
+        try:
+            self.ser = serial.Serial(self.device, self.baudrate, timeout=0)
+        except (serial.SerialException, OSError), err:
+            if self.retry_at == 0.0:
+                cam_log.warn("Can't open %s: %s. Will keep trying."
+                             % (self.device, err))
+            self.retry_at = now + 5.0
+            return
+        self.retry_at = 0.0
+        # readinto() on the port's file descriptor fills buf directly
+        self.port_in = io.FileIO(self.ser.fileno(), "r", closefd=False)
+        self.settings = self.ser.getSettingsDict()
+        cam_log.info("Serving %s on port %d" % (self.device, self.tcp_port))
+        self.update()
+
+    def close_serial(self):
+        if self.ser is None:
+            return
+        self.poller.forget(self.ser.fileno())
+        self.ser.close()
+        self.ser = None
+        self.port_in = None
+
+    def update(self):
+        """register for what we're waiting for on the port and the client"""
+        if self.ser is not None:
+            mask = ERROR
+            # stop reading the port while the client isn't keeping up
+            if self.end < len(self.buf) or self.start > 0:
+                mask |= READ
+            if self.netstart < self.netend:
+                mask |= WRITE
+            self.poller.set(self.ser.fileno(), mask, self.on_serial)
+        if self.sock is not None:
+            mask = ERROR
+            if self.netend < len(self.netbuf):
+                mask |= READ
+            if self.outq or self.escaped or (self.start < self.end and
+                                             self.flush_at is None):
+                mask |= WRITE
+            self.poller.set(self.sock.fileno(), mask, self.on_client)
+
+    def on_server(self, event, now):
+        try:
+            sock, addr = self.server.accept()
+        except socket.error:
+            return
+        if self.sock is not None or self.ser is None:
+            cam_log.warn("%s: turning away %s:%d" % ((self.name(),) + addr))
+            sock.close()
+            return
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.clients += 1
+        self.start = self.end = 0
+        self.netstart = self.netend = 0
+        self.outq = ""
+        self.escaped = ""
+        self.flush_at = None
+        self.ser.flushInput()
+        cam_log.info("%s: client connected from %s:%d" %
+                     ((self.name(),) + addr))
+        if self.telnet:
+            self.rfc2217 = serial.rfc2217.PortManager(self.ser, self)
+            self.modem_at = 0.0
+        self.update()
+
+    def write(self, data):
+        """telnet replies from the RFC 2217 port manager"""
+        self.outq += data
+
+    def on_serial(self, event, now):
+        if event & READ:
+            self.serial_read(now)
+        if self.ser is not None and event & WRITE:
+            self.serial_write(now)
+        if self.ser is not None and event & ERROR and not event & READ:
+            self.serial_error("port closed")
+        self.update()
+
+    def on_client(self, event, now):
+        if event & READ:
+            self.socket_read(now)
+        if self.sock is not None and event & WRITE:
+            self.flush(now)
+        if self.sock is not None and event & ERROR and not event & READ:
+            self.disconnect()
+        self.update()
+
+    def serial_read(self, now):
+        if self.end == len(self.buf) and self.start > 0:
+            # move what's still to be sent to the front to make room
+            n = self.end - self.start
+            self.buf[:n] = self.view[self.start:self.end]
+            self.start, self.end = 0, n
+        try:
+            n = self.port_in.readinto(self.view[self.end:])
+        except (IOError, OSError), err:
+            self.serial_error(err)
+            return
+        if n is None:
+            # nothing there after all
+            return
+        if n == 0:
+            self.serial_error("port closed")
+            return
+        self.stats.count("port_reads")
+        if self.sock is None:
+            # nobody to send it to
+            return
+        if self.first_byte is None:
+            self.first_byte = now
+        self.end += n
+        if self.end - self.start >= self.batch:
+            self.flush_at = None
+            self.flush(now)
+        else:
+            # the rest of a block is probably on its way
+            self.flush_at = now + self.gap
+
+    def serial_write(self, now):
+        try:
+            n = os.write(self.ser.fileno(),
+                         self.netview[self.netstart:self.netend])
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return
+            self.serial_error(err)
+            return
+        self.netstart += n
+        self.bytes_to_port += n
+        if self.netstart == self.netend:
+            self.netstart = self.netend = 0
+
+    def socket_read(self, now):
+        try:
+            n = self.sock.recv_into(self.netview[self.netend:])
+        except socket.error, err:
+            if err.args[0] == errno.EAGAIN:
+                return
+            self.disconnect(err)
+            return
+        if n == 0:
+            self.disconnect()
+            return
+        self.stats.count("net_reads")
+        if self.rfc2217 is not None:
+            # the client's side is mostly block acks, a few bytes at a time
+            baudrate = self.ser.baudrate
+            data = serial.to_bytes(self.rfc2217.filter(
+                self.netview[self.netend:self.netend + n].tobytes()))
+            if self.ser.baudrate != baudrate:
+                self.baudrate_changed()
+            n = len(data)
+            self.netbuf[self.netend:self.netend + n] = data
+        self.netend += n
+        if n:
+            t0 = time.time()
+            self.serial_write(now)
+            self.stats.observe("net_to_camera", time.time() - t0)
+
+    def flush(self, now):
+        """send as much of what's waiting as the client will take"""
+        if self.sock is None:
+            return
+        try:
+            # an escaped chunk has to be finished before a telnet reply goes
+            # out, or the reply could land between the two bytes of an IAC
+            if self.escaped and not self.send_escaped():
+                return
+            if self.outq:
+                n = self.sock.send(self.outq)
+                self.outq = self.outq[n:]
+                self.stats.count("net_sends")
+                if self.outq:
+                    return
+            if self.start < self.end:
+                end = self.end
+                if self.rfc2217 is not None:
+                    iac = self.buf.find(IAC, self.start, self.end)
+                    if iac >= 0:
+                        end = iac
+                if self.start < end:
+                    n = self.sock.send(self.view[self.start:end])
+                    self.start += n
+                    self.bytes_to_net += n
+                    self.stats.count("net_sends")
+                if self.start == end < self.end:
+                    # escape from the first IAC on and send that from a copy
+                    self.escaped = self.view[self.start:self.end].tobytes(
+                        ).replace(IAC, IAC + IAC)
+                    self.escaped_sent = 0
+                    self.bytes_to_net += self.end - self.start
+                    self.start = self.end
+                    self.stats.count("escaped_chunks")
+                    self.send_escaped()
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.ENOBUFS):
+                return
+            self.disconnect(err)
+            return
+        if self.start == self.end:
+            self.start = self.end = 0
+            if self.first_byte is not None and not self.escaped:
+                dt = time.time() - self.first_byte
+                self.busy += dt
+                self.stats.observe("camera_to_net", dt)
+                self.first_byte = None
+
+    def send_escaped(self):
+        """send more of the escaped chunk.  True once it's all gone."""
+        n = self.sock.send(memoryview(self.escaped)[self.escaped_sent:])
+        self.escaped_sent += n
+        self.stats.count("net_sends")
+        if self.escaped_sent < len(self.escaped):
+            return False
+        self.escaped = ""
+        return True
+
+    def serial_error(self, err):
+        cam_log.error("%s: %s. Closing it." % (self.name(), err))
+        self.disconnect()
+        self.close_serial()
+        self.retry_at = time.time() + 5.0
+
+    def disconnect(self, err=None):
+        if self.sock is None:
+            return
+        if err is not None:
+            cam_log.info("%s: client went away: %s" % (self.name(), err))
+        else:
+            cam_log.info("%s: client disconnected" % self.name())
+        self.poller.forget(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        self.rfc2217 = None
+        self.start = self.end = 0
+        self.outq = ""
+        self.escaped = ""
+        self.flush_at = None
+        self.first_byte = None
+        if self.ser is not None:
+            # undo anything an RFC 2217 client changed
+            self.ser.applySettingsDict(self.settings)
+            self.baudrate_changed()
+            self.update()
+
+    def baudrate_changed(self):
+        """work out the gap again for the port's new baudrate"""
+        if self.auto_gap:
+            self.gap = default_gap(self.ser.baudrate)
+
+    def report(self, now=None):
+        """counters, latencies and throughput for this camera"""
+        if now is None:
+            now = time.time()
+        t, nbytes = self.last_report
+        recent = 0.0
+        if now > t:
+            recent = (self.bytes_to_net - nbytes) / (now - t)
+        self.last_report = (now, self.bytes_to_net)
+        rate = 0.0
+        if self.busy > 0:
+            rate = self.bytes_to_net / self.busy
+        return {"device": self.device,
+                "tcp_port": self.tcp_port,
+                "open": self.ser is not None,
+                "connected": self.sock is not None,
+                "clients": self.clients,
+                "bytes_to_net": self.bytes_to_net,
+                "bytes_to_port": self.bytes_to_port,
+                "busy": self.busy,
+                "bytes_per_sec": rate,
+                "recent_bytes_per_sec": recent,
+                "stats": self.stats.as_dict()}
+
+
+class CameraGateway(object):
+    def __init__(self, stats_file=None, stats_interval=60.0):
+        self.poller = Poller()
+        self.ports = []
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.running = False
+
+    def add(self, device, tcp_port, **kwargs):
+        """serve device on tcp_port.  see CameraPort for the options."""
+        port = CameraPort(self.poller, device, tcp_port, **kwargs)
+        port.open()
+        self.ports.append(port)
+        return port
+
+    def run(self):
+        """serve until stop() is called"""
+        self.running = True
+        next_report = time.time() + self.stats_interval
+        while self.running:
+            now = time.time()
+            timeout = 1.0
+            for port in self.ports:
+                if port.flush_at is not None:
+                    timeout = min(timeout, max(0.0, port.flush_at - now))
+            self.poller.poll(timeout)
+            now = time.time()
+            for port in self.ports:
+                port.tick(now)
+                port.update()
+            if self.stats_file and now >= next_report:
+                next_report = now + self.stats_interval
+                try:
+                    dump_json(self.report(), self.stats_file)
+                except (IOError, OSError), err:
+                    cam_log.warn("Could not write stats to %s: %s" %
+                                 (self.stats_file, err))
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        for port in self.ports:
+            port.close()
+
+    def report(self):
+        now = time.time()
+        return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "ports": dict((port.name(), port.report(now))
+                              for port in self.ports)}
+
+
+def parse_port(spec):
+    """device, tcp port and baudrate from device:tcp_port[:baudrate]"""
+    parts = spec.split(":")
+    if len(parts) == 2:
+        return parts[0], int(parts[1]), 460800
+    if len(parts) == 3:
+        return parts[0], int(parts[1]), int(parts[2])
+    raise ValueError("Expected device:tcp_port[:baudrate], got %s" % spec)
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(
+        usage="%prog [options] device:tcp_port[:baudrate] ...")
+    parser.add_option("-H", "--host", default="",
+                      help="address to listen on (default: all)")
+    parser.add_option("--rfc2217", action="store_true", default=False,
+                      help="speak RFC 2217 instead of raw TCP")
+    parser.add_option("--gap", type=float, default=None,
+                      help="forward data from a port once it's been quiet "
+                      "this long, in seconds (default: 0.003 plus 20 "
+                      "character times)")
+    parser.add_option("--stats", default=None,
+                      help="write per-camera stats here as JSON")
+    parser.add_option("--stats-interval", type=float, default=60.0,
+                      help="seconds between stats updates (default: 60)")
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error("no ports given")
+
+    setup_logging()
+    gateway = CameraGateway(stats_file=opts.stats,
+                            stats_interval=opts.stats_interval)
+    for spec in args:
+        device, tcp_port, baudrate = parse_port(spec)
+        gateway.add(device, tcp_port, baudrate=baudrate,
+                    telnet=opts.rfc2217, host=opts.host, gap=opts.gap)
+    try:
+        gateway.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.close()
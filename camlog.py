@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+                camlog
+
+Logging for the camera code that stays off the acquisition thread.
+
+Nothing is configured at import.  setup_logging() (which AllSky340 calls when
+a camera is opened) hangs a QueueHandler on the root logger that does nothing
+more than put the record on a queue.  A background thread takes them off and
+writes them to the terminal (with ANSI colors) and to $HOME/skycam.log.  If
+the queue ever fills up records are dropped and counted rather than block
+the caller.  Anything still queued is written out at exit.
+
+RateLimited wraps a logger for messages that can come in bursts, like block
+retransmits during a readout.  It lets through one message per key every
+interval seconds and says how many were held back when it next lets one
+through.
+"""
+
+import os
+import sys
+import time
+import atexit
+import Queue
+import logging
+import threading
+
+cam_log = logging.getLogger("skycam")
+
+COLORS = [(50, '\x1b[31m'),  # red
+          (40, '\x1b[31m'),  # red
+          (30, '\x1b[33m'),  # yellow
+          (20, '\x1b[32m'),  # green
+          (10, '\x1b[35m')]  # pink
+
+
+class ColorFormatter(logging.Formatter):
+    """color the level name by severity, for terminals"""
+    def format(self, record):
+        levelname = record.levelname
+        color = '\x1b[0m'  # normal
+        for level, c in COLORS:
+            if record.levelno >= level:
+                color = c
+                break
+        record.levelname = color + levelname + '\x1b[0m'
+        try:
+            return logging.Formatter.format(self, record)
+        finally:
+            record.levelname = levelname
+
+
+class QueueHandler(logging.Handler):
+    """
+    hand records over to a queue.  the message is formatted here, while the
+    arguments are still what they were when it was logged, and exception
+    info is turned into text since tracebacks don't travel well.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """a thread that passes records from a queue on to some handlers"""
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = threading.Thread(target=self.run, name="camlog")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for h in self.handlers:
+                if record.levelno >= h.level:
+                    h.handle(record)
+
+    def stop(self, timeout=5.0):
+        """write out whatever is still queued and stop the thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+        for h in self.handlers:
+            h.flush()
+
+_listener = None
+_handler = None
+
+
+def setup_logging(filename=None, level=logging.INFO, queue_size=10000):
+    """
+    log to the terminal and to filename ($HOME/skycam.log by default) via a
+    queue and a writer thread.  does nothing if it's already been done, or
+    if the application has set up logging itself.
+    """
+    global _listener, _handler
+    root = logging.getLogger()
+    if _listener is not None or root.handlers:
+        return _handler
+    if filename is None:
+        filename = os.path.join(os.path.expanduser("~"), "skycam.log")
+
+    ch = logging.StreamHandler(sys.stderr)
+    ch.setFormatter(ColorFormatter("%(levelname)s: %(message)s"))
+    handlers = [ch]
+    try:
+        fh = logging.FileHandler(filename)
+        fh.setLevel(logging.DEBUG)
+        fh.setFormatter(logging.Formatter(
+            "%(asctime)s: %(levelname)s - %(message)s"))
+        handlers.append(fh)
+    except IOError, err:
+        sys.stderr.write("Can't log to %s: %s\n" % (filename, err))
+
+    queue = Queue.Queue(queue_size)
+    _handler = QueueHandler(queue)
+    _listener = QueueListener(queue, handlers)
+    _listener.start()
+    root.addHandler(_handler)
+    root.setLevel(level)
+    atexit.register(_listener.stop)
+    return _handler
+
+
+def dropped():
+    """how many records have been dropped because the queue was full"""
+    if _handler is None:
+        return 0
+    return _handler.dropped
+
+
+class RateLimited(object):
+    """
+    log at most one message per key every interval seconds.  the key
+    defaults to the message format, so the same message with different
+    numbers in it counts as a repeat.
+    """
+    def __init__(self, logger=cam_log, interval=1.0):
+        self.logger = logger
+        self.interval = interval
+        self.last = {}
+        self.suppressed = {}
+
+    def log(self, level, msg, *args, **kwargs):
+        key = kwargs.pop("key", msg)
+        now = time.time()
+        if now - self.last.get(key, 0.0) < self.interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+        self.last[key] = now
+        n = self.suppressed.pop(key, 0)
+        if n:
+            msg = msg + " (%d similar message(s) suppressed)" % n
+        self.logger.log(level, msg, *args)
+        return True
+
+    def info(self, msg, *args, **kwargs):
+        return self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warn(self, msg, *args, **kwargs):
+        return self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        return self.log(logging.ERROR, msg, *args, **kwargs)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+                camstats
+
+Cheap counters and timing histograms for keeping an eye on the camera link.
+Stats keeps named counters and named Histograms; both are created on first
+use:
+
+    stats = Stats()
+    stats.count("lrc_failures")
+    stats.observe("block", 0.182)
+    stats.histograms["block"].percentile(99)
+    json.dumps(stats.as_dict())
+
+Histograms have fixed log-spaced buckets (8 per decade from 10 us to 10000 s)
+so recording a value is a bisect and an increment however many there are.
+Percentiles are read off the buckets and so are good to about 30%; min, max
+and mean are exact.
+"""
+
+import os
+import json
+import math
+import bisect
+
+# bucket upper edges in seconds
+BUCKETS = [10.0 ** (e / 8.0) for e in range(-40, 33)]
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.n += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.n == 0:
+            return None
+        return self.total / self.n
+
+    def percentile(self, q):
+        """
+        upper edge of the bucket holding the q'th percentile, clipped to the
+        largest value seen
+        """
+        if self.n == 0:
+            return None
+        rank = int(math.ceil(q / 100.0 * self.n))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= max(rank, 1):
+                if i < len(BUCKETS):
+                    return min(BUCKETS[i], self.max)
+                return self.max
+        return self.max
+
+    def as_dict(self):
+        return {"n": self.n,
+                "mean": self.mean(),
+                "min": self.min,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+
+class Stats(object):
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.observe(value)
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def as_dict(self):
+        return {"counters": dict(self.counters),
+                "histograms": dict((k, h.as_dict())
+                                   for k, h in self.histograms.items())}
+
+
+def dump_json(obj, filename):
+    """
+    write obj to filename as JSON, via a temporary file so a reader never
+    sees a half-written one
+    """
+    tmp = filename + ".tmp"
+    f = open(tmp, "w")
+    json.dump(obj, f, indent=2, sort_keys=True)
+    f.close()
+    os.rename(tmp, filename)
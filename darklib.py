@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+"""
+                darklib
+
+A library of master darks so light frames never have to wait for a dark.
+
+Each master dark is the median of several dark frames at one exposure time
+and readout mode.  They're kept on disk (one .npz per dark in the library
+directory) and the most recently used are also kept in memory.  get() hands
+back the dark whose exposure time is nearest the one asked for, preferring
+ones younger than max_age, straight away.  wanted() lists the exposure
+times on the library's ladder that have no fresh dark, most recently used
+first, and fill() takes darks for them; call it when the sky is no use
+anyway (daytime, clouds, dome closed) and the library keeps itself topped
+up:
+
+    library = DarkLibrary("/var/www/skycam/darks")
+    if daytime:
+        library.fill(cam, max_darks=1)
+    dark = library.get(60.0)
+    if dark is not None:
+        imag -= dark.image
+
+Darks older than keep_age are deleted from disk.  Until then an expired dark
+is still better than none, so get() falls back on one if there's nothing
+fresher.
+
+Auto-exposure can ask for any exposure time, though, not just the ones on
+the ladder.  DarkModel fits each pixel's dark level as an offset plus a
+dark current times the exposure time from a few of the library's darks and
+makes a dark for any exposure time from that.  library.model() fits one
+from the fresh darks and library.dark_for() uses it when there's no dark
+for exactly the exposure time wanted.  How well the model does is measured
+by leaving each real dark out of the fit in turn and comparing the model's
+prediction for it with the real thing; those residuals are in report(), so
+it's easy to see whether the model is good enough to stop taking darks at
+night.
+
+Run as a script it lists what's in a library.
+"""
+
+import os
+import time
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+from AllSky340 import pixel_mask
+from camlog import cam_log
+
+# exposure times skycam's auto-exposure steps through: 60 s halved down to
+# about 15 ms
+DEFAULT_EXPTIMES = [60.0 / 2 ** k for k in range(13)]
+
+# a master dark.  image is int32, good is False where none of the frames
+# had valid pixels, time is when it was made.
+Dark = namedtuple("Dark", ["image", "good", "exptime", "mode", "time",
+                           "nframes"])
+
+
+def master_dark(frames, masks=None):
+    """
+    median of a list of dark frames, leaving out pixels masked False.
+    returns (image, good) where good is False where no frame had a valid
+    pixel.
+    """
+    stack = np.array(frames, dtype=np.float32)
+    if masks is not None:
+        stack[~np.array(masks, dtype=bool)] = np.nan
+    with np.errstate(invalid="ignore"):
+        med = np.nanmedian(stack, axis=0)
+    good = ~np.isnan(med)
+    med[~good] = 0.0
+    return np.rint(med).astype(np.int32), good
+
+
+def fit_dark(darks):
+    """
+    least squares fit of offset + rate * exptime to each pixel of darks,
+    leaving out pixels that aren't good.  returns (offset, rate, good), with
+    good False where fewer than two different exposure times had the pixel.
+    """
+    shape = darks[0].image.shape
+    s = np.zeros(shape)
+    st = np.zeros(shape)
+    stt = np.zeros(shape)
+    sy = np.zeros(shape)
+    sty = np.zeros(shape)
+    for dark in darks:
+        w = dark.good.astype(np.float64)
+        t = dark.exptime
+        y = w * dark.image
+        s += w
+        st += w * t
+        stt += w * (t * t)
+        sy += y
+        sty += t * y
+    det = s * stt - st * st
+    # det is 0 unless the pixel was seen at two exposure times or more
+    good = det > 1e-12 * np.maximum(stt * stt, 1e-30)
+    det[~good] = 1.0
+    rate = (s * sty - st * sy) / det
+    offset = (stt * sy - st * sty) / det
+    rate[~good] = 0.0
+    offset[~good] = 0.0
+    return offset, rate, good
+
+
+def residuals(predicted, dark):
+    """how far predicted is from the real dark, over the pixels both have"""
+    good = predicted.good & dark.good
+    diff = (predicted.image[good] - dark.image[good]).astype(np.float64)
+    if diff.size == 0:
+        return None
+    return {"exptime": dark.exptime,
+            "mean": float(diff.mean()),
+            "rms": float(np.sqrt(np.mean(diff * diff))),
+            "p99": float(np.percentile(np.abs(diff), 99)),
+            "pixels": int(diff.size)}
+
+
+class DarkModel(object):
+    def __init__(self, darks):
+        """
+        fit the dark level of each pixel as offset + rate * exptime to darks,
+        a list of Dark taken in the same readout mode at at least two
+        different exposure times.
+        """
+        if len(set(d.exptime for d in darks)) < 2:
+            raise ValueError("A dark model needs darks at two or more "
+                             "exposure times")
+        self.mode = darks[0].mode
+        self.exptimes = sorted(d.exptime for d in darks)
+        self.time = min(d.time for d in darks)
+        self.nframes = sum(d.nframes for d in darks)
+        self.offset, self.rate, self.good = fit_dark(darks)
+        self.residuals = self.cross_validate(darks)
+
+    def dark(self, exptime):
+        """a Dark for exptime made from the model"""
+        image = np.rint(self.offset + exptime * self.rate).astype(np.int32)
+        return Dark(image, self.good, exptime, self.mode, self.time,
+                    self.nframes)
+
+    def cross_validate(self, darks):
+        """
+        leave each dark out of the fit in turn and see how well the rest
+        predict it.  darks that can't be left out (there'd be only one
+        exposure time left) are skipped.
+        """
+        results = []
+        for i, dark in enumerate(darks):
+            rest = darks[:i] + darks[i + 1:]
+            if len(set(d.exptime for d in rest)) < 2:
+                continue
+            offset, rate, good = fit_dark(rest)
+            image = np.rint(offset + dark.exptime * rate).astype(np.int32)
+            r = residuals(Dark(image, good, dark.exptime, self.mode, 0.0, 0),
+                          dark)
+            if r is not None:
+                results.append(r)
+        return results
+
+    def worst_rms(self):
+        """the largest cross-validated rms residual, None if there are none"""
+        if not self.residuals:
+            return None
+        return max(r["rms"] for r in self.residuals)
+
+    def report(self):
+        rate = self.rate[self.good]
+        offset = self.offset[self.good]
+        return {"exptimes": self.exptimes,
+                "good": float(self.good.mean()),
+                "offset_median": float(np.median(offset)),
+                "rate_median": float(np.median(rate)),
+                "residuals": self.residuals,
+                "worst_rms": self.worst_rms()}
+
+
+class DarkLibrary(object):
+    def __init__(self, path, exptimes=DEFAULT_EXPTIMES, mode="full",
+                 nframes=5, max_age=36 * 3600.0, keep_age=7 * 86400.0,
+                 max_cached=8, max_model_rms=None):
+        """
+        path is the directory darks are kept in.  exptimes is the ladder of
+        exposure times fill() keeps darks for, in readout mode mode, each
+        the median of nframes frames.  darks older than max_age seconds are
+        due to be replaced and ones older than keep_age are deleted.  up to
+        max_cached darks are kept in memory.  dark_for() only uses the dark
+        model if its worst cross-validated rms residual is under
+        max_model_rms ADU (by default it always does).
+        """
+        self.path = path
+        self.exptimes = sorted(exptimes)
+        self.mode = mode
+        self.nframes = nframes
+        self.max_age = max_age
+        self.keep_age = keep_age
+        self.max_cached = max_cached
+        # what's on disk, by exposure time: (time made, nframes, filename)
+        self.index = {}
+        # darks in memory, least recently used first
+        self.cache = OrderedDict()
+        # when each exposure time was last asked for
+        self.used = {}
+        self.max_model_rms = max_model_rms
+        # the dark model and the index it was fitted to
+        self._model = None
+        self._model_index = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.scan()
+
+    def filename(self, exptime):
+        return os.path.join(self.path, "dark_%s_%010.4fs.npz" %
+                            (self.mode, exptime))
+
+    def scan(self):
+        """find the darks on disk, reading just their metadata"""
+        self.index = {}
+        prefix = "dark_%s_" % self.mode
+        for name in os.listdir(self.path):
+            if not (name.startswith(prefix) and name.endswith(".npz")):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                f = np.load(filename)
+                try:
+                    exptime = float(f["exptime"])
+                    made = float(f["time"])
+                    nframes = int(f["nframes"])
+                finally:
+                    f.close()
+            except (IOError, OSError, KeyError, ValueError), err:
+                cam_log.warn("Skipping bad dark %s: %s" % (filename, err))
+                continue
+            self.index[exptime] = (made, nframes, filename)
+        return len(self.index)
+
+    def load(self, exptime):
+        """the dark for exactly exptime, from memory or disk"""
+        dark = self.cache.get(exptime)
+        if dark is None:
+            dark = self.read(exptime)
+        self.remember(dark)
+        return dark
+
+    def read(self, exptime):
+        """the dark for exactly exptime from disk, leaving the cache be"""
+        made, nframes, filename = self.index[exptime]
+        f = np.load(filename)
+        try:
+            return Dark(f["image"], f["good"], exptime, self.mode, made,
+                        nframes)
+        finally:
+            f.close()
+
+    def remember(self, dark):
+        """keep dark in memory as the most recently used"""
+        self.cache.pop(dark.exptime, None)
+        self.cache[dark.exptime] = dark
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
+    def nearest(self, exptime, candidates):
+        """the candidate nearest exptime in log exposure time"""
+        return min(candidates, key=lambda e: abs(np.log(e / exptime)))
+
+    def get(self, exptime, now=None):
+        """
+        the best dark to use for exptime: the nearest in exposure time of
+        the ones that haven't expired, or of all of them if they all have.
+        None if the library is empty.
+        """
+        if now is None:
+            now = time.time()
+        self.used[exptime] = now
+        if not self.index:
+            return None
+        fresh = [e for e, (made, n, f) in self.index.items()
+                 if now - made < self.max_age]
+        if fresh:
+            best = self.nearest(exptime, fresh)
+        else:
+            best = self.nearest(exptime, self.index.keys())
+            cam_log.warn("No fresh darks. Using a %.1f h old one." %
+                         ((now - self.index[best][0]) / 3600.0))
+        try:
+            return self.load(best)
+        except (IOError, OSError, KeyError), err:
+            cam_log.error("Could not read dark for %g s: %s" % (best, err))
+            del self.index[best]
+            return self.get(exptime, now)
+
+    def model(self, now=None):
+        """
+        a DarkModel fitted to the fresh darks, refitted when they change.
+        None if there aren't fresh darks at two exposure times yet.
+        """
+        if now is None:
+            now = time.time()
+        fresh = sorted((e, v) for e, v in self.index.items()
+                       if now - v[0] < self.max_age)
+        if fresh == self._model_index:
+            return self._model
+        self._model = None
+        self._model_index = fresh
+        if len(fresh) < 2:
+            return None
+        try:
+            darks = [self.cache.get(e) or self.read(e) for e, v in fresh]
+        except (IOError, OSError, KeyError), err:
+            cam_log.error("Could not read darks for the dark model: %s" % err)
+            self._model_index = None
+            return None
+        self._model = DarkModel(darks)
+        cam_log.info("Fitted a dark model to %d darks. Worst rms residual "
+                     "%s ADU." % (len(darks), self._model.worst_rms()))
+        return self._model
+
+    def dark_for(self, exptime, now=None):
+        """
+        a dark for exactly exptime: the library's own if it has a fresh one,
+        otherwise one made from the dark model if that's good enough,
+        otherwise the nearest, as get() would return.  None if the library
+        is empty.
+        """
+        if now is None:
+            now = time.time()
+        dark = self.get(exptime, now)
+        if dark is None or (dark.exptime == exptime and
+                            now - dark.time < self.max_age):
+            return dark
+        model = self.model(now)
+        if model is None:
+            return dark
+        rms = model.worst_rms()
+        if self.max_model_rms is not None and \
+                (rms is None or rms > self.max_model_rms):
+            return dark
+        return model.dark(exptime)
+
+    def add(self, dark):
+        """put a new master dark in the library, replacing any older one"""
+        filename = self.filename(dark.exptime)
+        tmp = filename + ".tmp"
+        f = open(tmp, "wb")
+        try:
+            np.savez(f, image=dark.image, good=dark.good,
+                     exptime=dark.exptime, time=dark.time,
+                     nframes=dark.nframes)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+        self.index[dark.exptime] = (dark.time, dark.nframes, filename)
+        self.remember(dark)
+        self.evict()
+
+    def build(self, cam, exptime, nframes=None):
+        """take nframes darks at exptime, combine and add them"""
+        if nframes is None:
+            nframes = self.nframes
+        cam_log.info("Taking %d darks of %g s for the dark library" %
+                     (nframes, exptime))
+        frames = []
+        masks = []
+        for i in range(nframes):
+            imag, valid = cam.getImage(exptime, light=False, dtype=np.int32,
+                                       mode=self.mode, with_mask=True)
+            frames.append(imag)
+            masks.append(pixel_mask(valid, imag.shape))
+        image, good = master_dark(frames, masks)
+        dark = Dark(image, good, exptime, self.mode, time.time(), nframes)
+        self.add(dark)
+        return dark
+
+    def wanted(self, now=None):
+        """
+        exposure times on the ladder with no dark younger than max_age,
+        the most recently used first, then the ones that have gone longest
+        without.
+        """
+        if now is None:
+            now = time.time()
+        due = []
+        for e in self.exptimes:
+            made = self.index.get(e, (0.0,))[0]
+            if now - made >= self.max_age:
+                due.append((-self.used.get(e, 0.0), made, e))
+        return [e for used, made, e in sorted(due)]
+
+    def fill(self, cam, max_darks=1, now=None):
+        """
+        take master darks for up to max_darks of the wanted() exposure
+        times.  returns how many were taken.
+        """
+        wanted = self.wanted(now)[:max_darks]
+        for exptime in wanted:
+            self.build(cam, exptime)
+        return len(wanted)
+
+    def evict(self, now=None):
+        """delete darks older than keep_age from memory and disk"""
+        if now is None:
+            now = time.time()
+        for exptime, (made, nframes, filename) in self.index.items():
+            if now - made < self.keep_age:
+                continue
+            cam_log.info("Removing %.1f day old dark for %g s" %
+                         ((now - made) / 86400.0, exptime))
+            del self.index[exptime]
+            self.cache.pop(exptime, None)
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+    def report(self, now=None):
+        """what's in the library, for the logs or JSON"""
+        if now is None:
+            now = time.time()
+        model = self.model(now)
+        return {"path": self.path,
+                "mode": self.mode,
+                "darks": dict(("%g" % e, {"age": now - made,
+                                          "nframes": n,
+                                          "fresh": now - made < self.max_age,
+                                          "cached": e in self.cache})
+                              for e, (made, n, f) in self.index.items()),
+                "wanted": self.wanted(now),
+                "model": model and model.report()}
+
+if __name__ == '__main__':
+    import sys
+    import json
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = "/var/www/skycam/darks"
+    library = DarkLibrary(path)
+    print(json.dumps(library.report(), indent=2, sort_keys=True))
@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+"""
+                fakecam
+
+A fake SBIG AllSky340 on a pseudo-terminal, for running, testing and
+benchmarking AllSky340 without the camera.  It speaks the serial protocol
+from the SG-4/AllSky-340 serial interface spec (see Doc/):
+
+    E  communications test        B0-B6  change baudrate (+ Test/k)
+    V  firmware version           T      take image (E/R/D progress)
+    X  transfer image (K/R/S)     A      abort image
+    K  de-energize shutter        O, C   open/close shutter
+    g  force guide relays         U      chopping shutter (undocumented)
+    S  define sub-frame           r      serial number
+
+with the command checksums and per-block LRC bytes the real camera uses.
+Responses are framed the way AllSky340 reads them from the real camera: the
+checksum echo in front of a command's response (e.g. ':O' for 'E'), five
+bytes of trailer after a full image transfer, and a byte after 'TestOk'.
+
+Images are synthetic: a bias level plus a per-pixel dark current (with some
+hot pixels) plus, for light frames, a vignetted sky and a field of stars,
+all scaled by the exposure time, plus read noise.
+
+The link can be slowed to the wire speed of the negotiated baudrate (or a
+fixed link_baud), given a turnaround latency, and made to corrupt bytes in
+the image blocks, either at random (error_rate, a probability per byte,
+optionally per baudrate) or deterministically (bad_blocks).  The fake
+camera also notices if the host's port is set to a different baudrate than
+its own and garbles what it sends, like a real mismatched link would.
+time_scale scales exposure times, progress ticks and wire time so long
+exposures can be run quickly.
+
+    cam = FakeAllSky340(error_rate=1e-5)
+    c = AllSky340(port=cam.port, baudrate=460800, timeout=0.5)
+    imag = c.getImage(1.0, light=True)
+    cam.close()
+
+Run as a script it prints the port to point AllSky340 at and serves until
+interrupted.
+"""
+
+import os
+import sys
+import pty
+import tty
+import time
+import select
+import struct
+import termios
+import threading
+import numpy as np
+
+from AllSky340 import checksum, block_lrc, BAUDRATES
+
+# pixel geometry of each readout mode (byte 4 of the T command): rows,
+# columns and pixels per block.  sub-frames are size x size with one line
+# per block and are filled in from the S command.
+MODES = {0x00: (480, 640, 4096),
+         0x01: (480, 512, 4096),
+         0x02: (240, 320, 1024)}
+SUBFRAME = 0xff
+
+# total length (including the command byte, excluding the checksum) of each
+# command we understand when the camera is idle.
+COMMAND_LENGTHS = {"E": 1, "V": 1, "O": 1, "C": 1, "K": 1, "A": 1, "X": 1,
+                   "k": 1, "r": 1, "T": 6, "B": 2, "g": 2, "U": 2, "S": 6}
+
+BAUD_COMMANDS = dict((v, k) for k, v in BAUDRATES.items())
+
+# bytes the camera sends after the last block of a transfer.  AllSky340 just
+# throws these away.
+TRAILER = "\x00" * 5
+
+TERMIOS_SPEEDS = dict((getattr(termios, "B%d" % b), b) for b in BAUDRATES
+                      if hasattr(termios, "B%d" % b))
+
+
+class FakeAllSky340(object):
+    def __init__(self, baudrate=460800, link_baud=None, latency=0.0,
+                 error_rate=0.0, bad_blocks=None, time_scale=1.0,
+                 sky_rate=200.0, readout_time=0.1, firmware=(1, 16),
+                 serial_number="FAKE00001", seed=None):
+        """
+        baudrate is the camera's power-up rate.  link_baud, if set, is the
+        speed actually used to pace data on the link no matter what rate is
+        negotiated; otherwise the negotiated rate is used and link_baud=0
+        turns pacing off altogether.  latency is added before every response
+        to the host.  error_rate is either a per-byte error probability or a
+        dict of them keyed by baudrate.  bad_blocks maps block index to how
+        many transmissions of that block to corrupt.  sky_rate is the sky
+        level in counts per second at the center of the field.
+        """
+        self.baudrate = baudrate
+        self.link_baud = link_baud
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bad_blocks = dict(bad_blocks or {})
+        self.time_scale = time_scale
+        self.sky_rate = sky_rate
+        self.readout_time = readout_time
+        self.version = firmware
+        self.serial_number = serial_number
+        self.rng = np.random.RandomState(seed)
+
+        self.bias = 1000.0
+        self.read_noise = 8.0
+        self.dark_rate = 2.0 * (1.0 + 0.1 * self.rng.standard_normal((480, 640)))
+        hot = self.rng.randint(0, 480 * 640, 200)
+        self.dark_rate.flat[hot] *= 50.0
+        self.stars = (self.rng.randint(0, 480, 300),
+                      self.rng.randint(0, 640, 300),
+                      self.rng.exponential(300.0, 300))
+
+        self.shutter = "closed"
+        self.relays = 0
+        self.chop = False
+        self.subframe = (0, 0, 100)
+        self.frame = (np.zeros((480, 640), dtype="<u2"), 0x00)
+        # how many times each block of the current frame has been sent
+        self.sent = {}
+
+        self.exposing = None
+        self.parked = False
+        self.xfer = None
+        self.baud_test = None
+        self.inbuf = ""
+
+        # some counters for tests and benchmarks
+        self.nexposures = 0
+        self.nblocks = 0
+        self.nretransmits = 0
+        self.ncorrupted = 0
+        self.bytes_sent = 0
+        # when the host first sent anything
+        self.first_read = None
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def host_baud(self):
+        """the baudrate the host side of the pty is currently set to"""
+        try:
+            speed = termios.tcgetattr(self.slave)[5]
+        except termios.error:
+            return None
+        return TERMIOS_SPEEDS.get(speed)
+
+    def link_rate(self):
+        """bytes per second on the (simulated) wire, or None if unpaced"""
+        baud = self.link_baud
+        if baud is None:
+            baud = self.baudrate
+        if not baud or not self.time_scale:
+            return None
+        return baud / 10.0 / self.time_scale
+
+    def block_error_rate(self):
+        if isinstance(self.error_rate, dict):
+            return self.error_rate.get(self.baudrate, 0.0)
+        return self.error_rate
+
+    def send(self, data):
+        """send data to the host, paced at the link rate"""
+        if not data:
+            return
+        host = self.host_baud()
+        if host is not None and host != self.baudrate:
+            # what a receiver at the wrong baudrate makes of it
+            data = self.rng.randint(0, 256, len(data)).astype(np.uint8).tostring()
+        self.bytes_sent += len(data)
+        rate = self.link_rate()
+        if rate is None:
+            self.write(data)
+            return
+        chunk = max(64, int(rate * 0.002))
+        start = time.time()
+        for i in range(0, len(data), chunk):
+            self.write(data[i:i + chunk])
+            wait = start + (i + chunk) / rate - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+    def write(self, data):
+        while data:
+            n = os.write(self.master, data)
+            data = data[n:]
+
+    def respond(self, data):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.send(data)
+
+    def serve(self):
+        while self.running:
+            now = time.time()
+            timeout = 0.05
+            if self.exposing is not None:
+                timeout = max(0.0, min(timeout, self.exposing["tick"] - now,
+                                       self.exposing["end"] - now))
+            try:
+                r, w, x = select.select([self.master], [], [], timeout)
+                if r:
+                    data = os.read(self.master, 65536)
+                    if not data:
+                        return
+                    if self.first_read is None:
+                        self.first_read = time.time()
+                    self.inbuf += data
+                    self.process()
+                self.tick()
+            except (OSError, select.error, ValueError):
+                # the pty has been closed under us
+                return
+
+    def tick(self):
+        """exposure progress and completion"""
+        if self.exposing is None:
+            return
+        now = time.time()
+        if now >= self.exposing["end"]:
+            if self.xfer is not None:
+                # charge is parked in the readout pixels until the download
+                # in progress is done
+                self.parked = True
+            else:
+                self.finish_exposure()
+        elif now >= self.exposing["tick"]:
+            self.exposing["tick"] = now + 0.15 * self.time_scale
+            if self.xfer is None:
+                self.send("E")
+
+    def finish_exposure(self):
+        exp = self.exposing
+        self.exposing = None
+        self.parked = False
+        self.send("R")
+        time.sleep(self.readout_time * self.time_scale)
+        self.frame = (self.make_image(exp["exptime"], exp["light"],
+                                      exp["mode"]), exp["mode"])
+        self.sent = {}
+        self.nexposures += 1
+        self.send("D")
+
+    def make_image(self, exptime, light, mode):
+        """a synthetic frame in the order the camera sends the rows"""
+        imag = self.bias + self.dark_rate * exptime
+        if light:
+            y, x = np.mgrid[0:480, 0:640]
+            r = np.hypot(x - 320.0, y - 240.0) / 240.0
+            sky = self.sky_rate * exptime * np.clip(1.0 - 0.5 * r ** 2, 0, 1)
+            sky[r > 1.0] = 0.0
+            imag = imag + sky
+            sy, sx, flux = self.stars
+            imag[sy, sx] += flux * exptime * (r[sy, sx] < 1.0)
+        imag = imag + self.rng.normal(0.0, self.read_noise, imag.shape)
+        if mode == 0x01:
+            imag = imag[:, 64:576]
+        elif mode == 0x02:
+            imag = imag.reshape(240, 2, 320, 2).sum(axis=3).sum(axis=1)
+        elif mode == SUBFRAME:
+            x0, y0, size = self.subframe
+            imag = imag[y0:y0 + size, x0:x0 + size]
+        return np.clip(imag, 0, 65535).astype("<u2")
+
+    def geometry(self, mode):
+        if mode == SUBFRAME:
+            size = self.subframe[2]
+            return size, size, size
+        return MODES[mode]
+
+    def process(self):
+        """handle whatever complete commands are in the input buffer"""
+        while self.inbuf:
+            if self.xfer is not None:
+                if not self.transfer_control():
+                    return
+            elif self.baud_test is not None:
+                if not self.baud_handshake():
+                    return
+            else:
+                c = self.inbuf[0]
+                n = COMMAND_LENGTHS.get(c)
+                if n is None:
+                    # not a command we know.  drop it and resync
+                    self.inbuf = self.inbuf[1:]
+                    continue
+                if len(self.inbuf) < n + 1:
+                    return
+                cmd = self.inbuf[:n]
+                cs = ord(self.inbuf[n])
+                self.inbuf = self.inbuf[n + 1:]
+                if cs != checksum(cmd):
+                    self.respond(chr(checksum(cmd)))
+                    continue
+                self.command(cmd)
+
+    def command(self, cmd):
+        c = cmd[0]
+        echo = chr(checksum(cmd))
+        if c == "E":
+            self.respond(echo + "O")
+        elif c == "V":
+            self.respond(echo + struct.pack("BB", *self.version))
+        elif c == "r":
+            self.respond(echo + self.serial_number[:9].ljust(9))
+        elif c == "O":
+            self.shutter = "open"
+        elif c == "C":
+            self.shutter = "closed"
+        elif c == "K":
+            self.shutter = "off"
+        elif c == "g":
+            self.relays = ord(cmd[1])
+        elif c == "U":
+            self.chop = bool(ord(cmd[1]))
+        elif c == "S":
+            x0, y0, size = struct.unpack(">HHB", cmd[1:])
+            self.subframe = (x0, y0, size & 0x7f)
+        elif c == "A":
+            if self.exposing is not None:
+                self.exposing["end"] = time.time()
+        elif c == "T":
+            self.expose(cmd, echo)
+        elif c == "X":
+            self.respond(echo)
+            self.start_transfer()
+        elif c == "B":
+            baud = BAUD_COMMANDS.get(cmd)
+            if baud is None:
+                return
+            self.respond(echo)
+            self.baud_test = (self.baudrate, time.time())
+            self.baudrate = baud
+            self.respond("S")
+
+    def expose(self, cmd, echo):
+        e = struct.unpack(">I", "\x00" + cmd[1:4])[0]
+        mode = ord(cmd[4])
+        imtype = ord(cmd[5])
+        if mode not in MODES and mode != SUBFRAME:
+            return
+        if e == 0:
+            exptime = 5.0e-5
+        else:
+            exptime = e * 1.0e-4
+        self.respond(echo)
+        now = time.time()
+        self.exposing = {"exptime": exptime, "light": imtype > 0,
+                         "mode": mode, "tick": now + 0.15 * self.time_scale,
+                         "end": now + exptime * self.time_scale}
+
+    def start_transfer(self):
+        imag, mode = self.frame
+        nrows, ncols, npix = self.geometry(mode)
+        self.xfer = {"raw": imag.tostring(), "npix": npix,
+                     "nblocks": imag.size // npix, "block": 0,
+                     "last": None}
+        self.send_block()
+
+    def send_block(self):
+        xfer = self.xfer
+        i = xfer["block"]
+        nbytes = xfer["npix"] * 2
+        block = xfer["raw"][i * nbytes:(i + 1) * nbytes]
+        lrc = block_lrc(block)
+        nsent = self.sent.get(i, 0)
+        self.sent[i] = nsent + 1
+        self.nblocks += 1
+        if nsent and xfer["last"] == i:
+            self.nretransmits += 1
+        nbad = 0
+        if self.bad_blocks.get(i, 0) > nsent:
+            nbad = 1
+        else:
+            p = self.block_error_rate()
+            if p > 0:
+                nbad = self.rng.binomial(nbytes, p)
+        if nbad:
+            self.ncorrupted += 1
+            block = bytearray(block)
+            for j in self.rng.randint(0, nbytes, nbad):
+                block[j] ^= 1 << self.rng.randint(0, 8)
+            block = str(block)
+        xfer["last"] = i
+        self.send(block + chr(lrc))
+
+    def transfer_control(self):
+        """K/R/S (each with its checksum) between blocks of a transfer"""
+        if len(self.inbuf) < 2:
+            return False
+        c = self.inbuf[0]
+        self.inbuf = self.inbuf[2:]
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if c == "K":
+            self.xfer["block"] += 1
+            if self.xfer["block"] >= self.xfer["nblocks"]:
+                self.end_transfer()
+                self.send(TRAILER)
+            else:
+                self.send_block()
+        elif c == "R":
+            self.send_block()
+        elif c == "S":
+            self.end_transfer()
+        return True
+
+    def end_transfer(self):
+        self.xfer = None
+        if self.parked:
+            self.finish_exposure()
+
+    def baud_handshake(self):
+        """the Test/TestOk/k exchange after a baudrate change"""
+        old_baud, started = self.baud_test
+        if time.time() - started > 2.0:
+            # handshake not completed.  go back to the old rate
+            self.baudrate = old_baud
+            self.baud_test = None
+            return True
+        if self.inbuf.startswith("Test"):
+            if len(self.inbuf) < 5:
+                return False
+            self.inbuf = self.inbuf[5:]
+            self.respond("TestOk" + chr(checksum("Test")))
+            self.baud_test = (old_baud, time.time())
+            return True
+        if self.inbuf.startswith("k"):
+            if len(self.inbuf) < 2:
+                return False
+            self.inbuf = self.inbuf[2:]
+            self.baud_test = None
+            return True
+        if len(self.inbuf) < 4 and "Test".startswith(self.inbuf):
+            return False
+        # anything else aborts the change
+        self.inbuf = self.inbuf[1:]
+        self.baudrate = old_baud
+        self.baud_test = None
+        return True
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option("-b", "--baudrate", type=int, default=460800,
+                      help="camera's power-up baudrate (default: 460800)")
+    parser.add_option("--link-baud", type=int, default=None,
+                      help="pace the link at this rate regardless of the "
+                      "negotiated baudrate (0 for no pacing)")
+    parser.add_option("-l", "--latency", type=float, default=0.0,
+                      help="turnaround latency in seconds")
+    parser.add_option("-e", "--error-rate", type=float, default=0.0,
+                      help="probability of corrupting each image byte")
+    parser.add_option("-t", "--time-scale", type=float, default=1.0,
+                      help="scale exposure times and wire time by this")
+    opts, args = parser.parse_args()
+
+    cam = FakeAllSky340(baudrate=opts.baudrate, link_baud=opts.link_baud,
+                        latency=opts.latency, error_rate=opts.error_rate,
+                        time_scale=opts.time_scale)
+    sys.stdout.write("Fake AllSky340 listening on %s\n" % cam.port)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        cam.close()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+                framepub
+
+Push frames from the acquisition process to anyone who wants them, as they
+come off the camera, without going through the disk.
+
+FramePublisher listens on a Unix socket (a path) or TCP (host:port).  Each
+frame passed to publish() is sent to every connected subscriber as a line
+of JSON metadata followed by the raw pixels:
+
+    {"seq": 12, "shape": [480, 640], "dtype": "int32", "nbytes": 1228800,
+     "exptime": 60.0, ...}\\n
+    <nbytes bytes of pixels>
+
+publish() never waits for a subscriber.  Each subscriber has its own
+sending thread and a short queue of frames; if a subscriber falls behind and
+its queue is full, the oldest frame in it is dropped.  A gap in seq tells a
+subscriber it has missed frames.
+
+subscribe() is the other end, a generator of (image, metadata) pairs:
+
+    for imag, meta in subscribe("/tmp/skycam-frames.sock"):
+        ...
+
+Run as a script it subscribes and prints the metadata of each frame.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+from collections import deque
+
+from camlog import cam_log
+from lazyimport import lazy_import
+
+np = lazy_import("numpy")
+
+FRAME_SOCKET = os.environ.get("SKYCAM_FRAMES", "/tmp/skycam-frames.sock")
+
+
+def parse_address(address):
+    """(family, address) for a Unix socket path or a host:port string"""
+    if not address.startswith("/") and ":" in address:
+        host, port = address.rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+class Subscriber(object):
+    def __init__(self, sock, name, maxlen):
+        self.sock = sock
+        self.name = name
+        self.queue = deque(maxlen=maxlen)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run,
+                                       name="framepub %s" % name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, msg):
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(msg)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    break
+                header, data = self.queue.popleft()
+            try:
+                self.sock.sendall(header)
+                self.sock.sendall(data)
+            except socket.error, err:
+                cam_log.info("Frame subscriber %s went away: %s" %
+                             (self.name, err))
+                break
+            self.sent += 1
+        self.close()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class FramePublisher(object):
+    def __init__(self, address=FRAME_SOCKET, maxlen=2):
+        """
+        address is a Unix socket path or host:port.  maxlen is how many
+        frames can be waiting for a subscriber before the oldest is dropped.
+        """
+        self.address = address
+        self.maxlen = maxlen
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.sock = None
+
+    def start(self):
+        """start accepting subscribers, in a background thread"""
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.listen(5)
+        thread = threading.Thread(target=self.accept, name="framepub")
+        thread.daemon = True
+        thread.start()
+        cam_log.info("Publishing frames on %s" % self.address)
+
+    def accept(self):
+        while self.sock is not None:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error:
+                break
+            if addr:
+                name = "%s:%d" % addr
+            else:
+                name = "#%d" % (len(self.subscribers) + 1)
+            cam_log.info("New frame subscriber %s" % name)
+            with self.lock:
+                self.subscribers.append(Subscriber(sock, name, self.maxlen))
+
+    def publish(self, imag, meta=None):
+        """
+        send imag, with the metadata in the meta dict, to every subscriber.
+        the pixels are copied so the caller can reuse imag straight away.
+        """
+        self.seq += 1
+        data = imag.tostring()
+        header = {}
+        if meta:
+            header.update(meta)
+        header.update(seq=self.seq, shape=list(imag.shape),
+                      dtype=str(imag.dtype), nbytes=len(data))
+        header.setdefault("time", time.time())
+        msg = (json.dumps(header) + "\n", data)
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if not s.closed]
+            for s in self.subscribers:
+                s.put(msg)
+        return self.seq
+
+    def stats(self):
+        with self.lock:
+            return {"frames": self.seq,
+                    "subscribers": [{"name": s.name, "sent": s.sent,
+                                     "dropped": s.dropped,
+                                     "queued": len(s.queue)}
+                                    for s in self.subscribers]}
+
+    def close(self):
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            # shutdown wakes up the accept() in the other thread
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        with self.lock:
+            for s in self.subscribers:
+                s.close()
+            self.subscribers = []
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+
+
+def subscribe(address=FRAME_SOCKET):
+    """connect to a FramePublisher and yield (image, metadata) per frame"""
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(addr)
+    f = sock.makefile("rb")
+    try:
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            meta = json.loads(line)
+            data = f.read(meta["nbytes"])
+            if len(data) < meta["nbytes"]:
+                return
+            imag = np.frombuffer(data, dtype=meta["dtype"])
+            yield imag.reshape(meta["shape"]), meta
+    finally:
+        f.close()
+        sock.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        address = sys.argv[1]
+    else:
+        address = FRAME_SOCKET
+    last = None
+    for imag, meta in subscribe(address):
+        if last is not None and meta["seq"] != last + 1:
+            print("missed %d frame(s)" % (meta["seq"] - last - 1))
+        last = meta["seq"]
+        print(json.dumps(meta, sort_keys=True))
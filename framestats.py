@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+                framestats
+
+Frame statistics from one histogram.  The pixels are integers in a range of
+at most a few times 65536, so a bincount of them is one pass over the frame
+and everything else is read off its cumulative sum without sorting:
+
+    s = FrameStats(imag, good)
+    lo, hi = s.percentiles([1, 99.5])
+    if s.median > 15000: ...
+    for key, value, comment in s.cards(): ...
+
+Percentiles interpolate between neighbouring pixel values the same way
+scipy.stats.scoreatpercentile and numpy.percentile do, so they're exact,
+not bucketed.  cards() has the summary as FITS header cards.
+"""
+
+import numpy as np
+
+# the camera's ADC tops out here
+SATURATION = 65535
+
+
+def histogram(values):
+    """
+    bincount of the integer array values.  returns (counts, lo) where
+    counts[i] is how many values are lo + i.
+    """
+    values = values.ravel()
+    if values.dtype.kind == "u" and values.dtype.itemsize <= 2:
+        # nothing to shift and the range is known
+        nbins = 1 << 8 * values.dtype.itemsize
+        return np.bincount(values, minlength=nbins), 0
+    lo = int(values.min())
+    hi = int(values.max())
+    if hi - lo > 1 << 20:
+        raise ValueError("Pixel values span %d to %d, too wide for a "
+                         "histogram" % (lo, hi))
+    return np.bincount(values - lo, minlength=hi - lo + 1), lo
+
+
+class FrameStats(object):
+    def __init__(self, imag, good=None, saturation=SATURATION,
+                 saturated=None):
+        """
+        statistics of the integer image imag, over the pixels where good is
+        True if it's given.  pixels at or above saturation count as
+        saturated, unless saturated, a count of them, is given instead (for
+        dark subtracted frames, where the raw level is what saturates).
+        """
+        if good is None or good.all():
+            values = imag
+        else:
+            values = imag[good]
+        self.n = values.size
+        self.total = imag.size
+        if self.n == 0:
+            raise ValueError("No good pixels")
+        self.counts, self.lo = histogram(values)
+        self.cumulative = np.cumsum(self.counts)
+        levels = np.arange(self.lo, self.lo + len(self.counts),
+                           dtype=np.float64)
+        self.mean = float(np.dot(self.counts, levels) / self.n)
+        nonzero = np.flatnonzero(self.counts)
+        self.min = self.lo + int(nonzero[0])
+        self.max = self.lo + int(nonzero[-1])
+        if saturated is None:
+            i = max(saturation - self.lo, 0)
+            saturated = int(self.counts[i:].sum())
+        self.saturated = saturated
+        self.median = self.percentile(50)
+
+    def value_at(self, rank):
+        """the rank'th smallest pixel value (0 based) for an array of ranks"""
+        return self.lo + np.searchsorted(self.cumulative, rank, side="right")
+
+    def percentiles(self, qs):
+        """the qs'th percentiles, as a list of floats"""
+        rank = np.asarray(qs, dtype=np.float64) / 100.0 * (self.n - 1)
+        below = np.floor(rank)
+        frac = rank - below
+        a = self.value_at(below)
+        b = self.value_at(np.minimum(below + 1, self.n - 1))
+        return [float(v) for v in a + frac * (b - a)]
+
+    def percentile(self, q):
+        return self.percentiles([q])[0]
+
+    def saturated_fraction(self):
+        return self.saturated / float(self.total)
+
+    def as_dict(self, qs=(1, 5, 25, 75, 95, 99.5)):
+        d = {"n": self.n,
+             "mean": self.mean,
+             "median": self.median,
+             "min": self.min,
+             "max": self.max,
+             "saturated": self.saturated_fraction()}
+        for q, v in zip(qs, self.percentiles(qs)):
+            d["p%g" % q] = v
+        return d
+
+    def cards(self):
+        """(keyword, value, comment) for a FITS header"""
+        p1, p995 = self.percentiles([1, 99.5])
+        return [("DATAMIN", self.min, "Lowest good pixel value"),
+                ("DATAMAX", self.max, "Highest good pixel value"),
+                ("MEAN", round(self.mean, 2), "Mean of good pixels"),
+                ("MEDIAN", self.median, "Median of good pixels"),
+                ("PCT1", p1, "1st percentile of good pixels"),
+                ("PCT99_5", p995, "99.5th percentile of good pixels"),
+                ("NGOOD", self.n, "Pixels in the statistics"),
+                ("SATFRAC", round(self.saturated_fraction(), 6),
+                 "Fraction of pixels saturated")]
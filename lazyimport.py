@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+                lazyimport
+
+Put off importing heavy modules until they're actually used.
+
+    np = lazy_import("numpy")
+
+gives a stand-in that imports numpy the first time an attribute of it is
+looked up, so a script that only pings the camera never pays for it.  Don't
+use one in a default argument or anything else evaluated at import time;
+that imports the module straight away.
+"""
+
+import sys
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            name = self.__dict__["_name"]
+            __import__(name)
+            module = sys.modules[name]
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<lazily imported module %r>" % self.__dict__["_name"]
+
+
+def lazy_import(name):
+    """a stand-in for module name that imports it on first use"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
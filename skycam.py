@@ -3,25 +3,53 @@
 import os
 import datetime as dt
 import time
+from math import radians, degrees, sin, cos, asin, atan2
 
+from AllSky340 import AllSky340, pixel_mask
+from skycamd import CameraDaemon
+from framepub import FramePublisher
+
+cam = AllSky340(port=os.environ.get("SKYCAM_PORT", "/dev/ttyUSB0"),
+                baudrate=460800,
+                timeout=0.1,
+                auto_baud=True,
+                scheduled_wait=True)
+cam.log_info("Image acquisition script starting up.")
+
+# operator commands (skycamctl.py) are run in between exposures, and every
+# frame is pushed out to anyone subscribed (see framepub.py)
+publisher = FramePublisher()
+publisher.start()
+daemon = CameraDaemon(cam, publisher=publisher)
+daemon.start()
+
+# these take a while to load.  open the camera first so that if there's a
+# problem with it we hear about it straight away.
 from astropy.io import fits as pyfits
 import matplotlib
 matplotlib.use('Agg')
 import pylab as pl
 import numpy as np
-from scipy import stats
-from AllSky340 import AllSky340
+from darklib import DarkLibrary
+from framestats import FrameStats, SATURATION
+from autoexp import AutoExposure
 
-cam = AllSky340(port="/dev/ttyUSB0",
-                baudrate=460800,
-                timeout=0.1)
-cam.log_info("Image acquisition script starting up.")
-
-ndark = 0
 exp = 60.0
 
 os.chdir("/var/www/skycam/")
 
+# darks come from the library, which takes them while the sun is up or the
+# CLOSED file is there, a few at a time in between light frames
+library = DarkLibrary("/var/www/skycam/darks")
+
+# picks exposure times from the library's ladder, so there's always a dark
+autoexp = AutoExposure(library.exptimes)
+
+# SALT, Sutherland
+LATITUDE = -32.3759
+LONGITUDE = 20.8107
+DAY_ALTITUDE = 0.0
+
 def get_obsdir():
    """return the obsdate directory"""
    now = dt.datetime.now() - dt.timedelta(days=0.5)
@@ -30,32 +58,92 @@ def get_obsdir():
    if not os.path.isdir(year): os.mkdir(year)
    if not os.path.isdir(obsdir): os.mkdir(obsdir)
    return obsdir
-    
+
+def sun_altitude(t=None):
+   """the sun's altitude in degrees, good to a degree or so"""
+   if t is None:
+      t = time.time()
+   d = t / 86400.0 - 10957.5   # days since J2000.0
+   g = radians(357.529 + 0.98560028 * d)
+   q = 280.459 + 0.98564736 * d
+   l = radians(q + 1.915 * sin(g) + 0.020 * sin(2 * g))
+   e = radians(23.439 - 0.00000036 * d)
+   ra = atan2(cos(e) * sin(l), cos(l))
+   dec = asin(sin(e) * sin(l))
+   gmst = 18.697374558 + 24.06570982441908 * d
+   ha = radians(gmst * 15.0 + LONGITUDE) - ra
+   lat = radians(LATITUDE)
+   return degrees(asin(sin(lat) * sin(dec) +
+                       cos(lat) * cos(dec) * cos(ha)))
+
+# with no darks at all there's nothing to subtract, so take one to start with
+if library.get(exp) is None:
+    library.build(cam, exp)
+
+# frames come from cam.sequence(), which starts each exposure before handing
+# over the last one.  operator commands are run by the sequence between two
+# frames; it's only stopped to fill the dark library.
+seq = None
 
 while True:
     if os.path.isfile("STOP"):
         cam.log_info("Image acquisition script shutting down.")
         os.system("rm STOP")
+        if seq is not None:
+            seq.close()
+        daemon.close()
+        publisher.close()
         break
 
+    fill = library.wanted() and (os.path.isfile("CLOSED") or
+                                 sun_altitude() > DAY_ALTITUDE)
+    if fill:
+        if seq is not None:
+            seq.close()
+            seq = None
+        daemon.run_pending()
+        try:
+            library.fill(cam, max_darks=1)
+        except Exception, err:
+            cam.log_err("Could not take darks: %s" % err)
+    elif seq is None:
+        daemon.run_pending()
+
     try:
-        if ndark == 0:
-            dark = cam.getImage(exp, light=False)
-            ndark += 1
+        if seq is None:
+            seq = cam.sequence(exp, light=True, dtype=np.int32,
+                               idle=daemon)
+            frame = seq.next()
+        else:
+            # a new exposure time applies from the frame after next
+            frame = seq.send(exp)
+    except Exception, err:
+        cam.log_err("Camera problem: %s" % err)
+        seq = None
+        time.sleep(1.0)
+        continue
 
-        imag = cam.getImage(exp, light=True)
+    try:
+        imag = frame.image
+        # leave out any blocks that didn't make it across from the stats
+        good = pixel_mask(frame.valid, imag.shape)
+        # what saturates is the raw level, so count it before the dark goes
+        saturated = np.count_nonzero(imag >= SATURATION)
+        dark = library.dark_for(frame.exptime)
+        if dark is not None:
+            imag -= dark.image
+            good &= dark.good
 
         # get the time and set up labels and filenames
         obsdir = get_obsdir()
         now = time.localtime()
-        imag -= dark
-        min = stats.scoreatpercentile(imag.flat, 1)
-        max = stats.scoreatpercentile(imag.flat, 99.5)
+        fstats = FrameStats(imag, good, saturated=saturated)
+        min, max = fstats.percentiles([1, 99.5])
         filename = obsdir+time.strftime("AllSky_%Y%m%d_%H%M%S.fits")
         jpg = obsdir+time.strftime("AllSky_%Y%m%d_%H%M%S.jpg")
         date = time.strftime("%Y/%m/%d")
         sast = time.strftime("%H:%M:%S")
-        elabel = "Exposure: %f sec" % exp
+        elabel = "Exposure: %f sec" % frame.exptime
 
         # set up and create the FITS file
         cards = []
@@ -63,7 +151,10 @@ while True:
         cards.append(pyfits.createCard("TIMEOBS",
                                        sast,
                                        "Time of observation (SAST)"))
-        cards.append(pyfits.createCard("EXPTIME", exp, "Exposure time (s)"))
+        cards.append(pyfits.createCard("EXPTIME", frame.exptime,
+                                       "Exposure time (s)"))
+        for key, value, comment in fstats.cards():
+            cards.append(pyfits.createCard(key, value, comment))
         header = pyfits.Header(cards=cards)
         pyfits.writeto(filename, imag, header=header, clobber=True)
 
@@ -82,25 +173,21 @@ while True:
         pl.text(630, 5, sast, color='w',
             verticalalignment='top', horizontalalignment='right',
             fontweight='bold')
-        pl.text(10, 475, "%.2g sec" % exp, color='w', fontweight='bold')
+        pl.text(10, 475, "%.2g sec" % frame.exptime, color='w',
+                fontweight='bold')
         pl.savefig(jpg, bbox_inches="tight", pad_inches=0.0, quality=95)
         pl.close()
 
         os.system("ln -sf /var/www/skycam/%s Data/AllSkyCurrentImage.JPG" % jpg)
         os.system("ln -sf /var/www/skycam/%s Data/AllSkyCurrentImage.fits" % filename)
+        daemon.set_latest(imag, {"exptime": frame.exptime, "light": True,
+                                 "valid": frame.valid, "filename": filename,
+                                 "stats": fstats.as_dict()})
+
+        # the next exposure (exp) has already started, so what's chosen now
+        # starts after it and its readout
+        exp = autoexp.update(frame.exptime, frame.timestamp, imag, good,
+                             stats=fstats, lead=exp + cam.transfer_time())
 
     except Exception, err:
         cam.log_err("Oops! Something went wrong...%s" % err) 
-
-    ndark += 1
-
-    if ndark > 10:
-        ndark = 0
-
-    if np.median(imag) > 15000.0:
-        exp /= 2.0
-        ndark = 0
-
-    if np.median(imag) < 4000.0 and exp < 60.0:
-        exp *= 2.0
-        ndark = 0
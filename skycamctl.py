@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+                skycamctl
+
+Client for the skycamd camera daemon.  Sends one command and prints the
+result as JSON:
+
+    skycamctl.py ping
+    skycamctl.py heater_on
+    skycamctl.py expose exptime=5.0 light=true mode=bin2x2
+    skycamctl.py latest -o latest.npy
+
+Arguments are name=value pairs; values are read as JSON where they can be
+(numbers, true/false) and as strings otherwise.  Commands that need the
+camera wait until the daemon gets to them between exposures.
+
+usage: skycamctl.py [options] command [name=value ...]
+"""
+
+import sys
+import json
+import socket
+import optparse
+
+from skycamd import SOCKET_PATH
+
+
+def request(cmd, path=SOCKET_PATH, timeout=600.0, **args):
+    """send cmd (with args) to the daemon and return its result"""
+    req = dict(args)
+    req["cmd"] = cmd
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(req) + "\n")
+        f = sock.makefile("r")
+        reply = json.loads(f.readline())
+        f.close()
+    finally:
+        sock.close()
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    return reply["result"]
+
+
+def parse_args(args):
+    kwargs = {}
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        if not sep:
+            raise ValueError("Arguments should be name=value, not %s" % arg)
+        try:
+            kwargs[name] = json.loads(value)
+        except ValueError:
+            kwargs[name] = value
+    return kwargs
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage="%prog [options] command [name=value ...]")
+    parser.add_option("-s", "--socket", default=SOCKET_PATH,
+                      help="daemon's socket (default: %s)" % SOCKET_PATH)
+    parser.add_option("-t", "--timeout", type=float, default=600.0,
+                      help="seconds to wait for an answer (default: 600)")
+    parser.add_option("-o", "--output", default=None,
+                      help="for latest: save the pixels to this .npy file")
+    opts, args = parser.parse_args(argv)
+    if not args:
+        parser.error("no command given")
+    cmd = args[0]
+    kwargs = parse_args(args[1:])
+    if cmd == "latest" and opts.output:
+        kwargs["pixels"] = True
+
+    try:
+        result = request(cmd, path=opts.socket, timeout=opts.timeout,
+                         **kwargs)
+    except (socket.error, RuntimeError), err:
+        sys.stderr.write("%s: %s\n" % (cmd, err))
+        return 1
+
+    if cmd == "latest" and opts.output and result is not None:
+        import base64
+        import numpy as np
+        pixels = np.frombuffer(base64.b64decode(result.pop("pixels")),
+                               dtype=result["dtype"])
+        np.save(opts.output, pixels.reshape(result["shape"]))
+    print(json.dumps(result, indent=2, sort_keys=True))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+                skycamd
+
+A camera daemon: one process owns the serial port and everyone else asks it
+to do things over a Unix socket, so operator commands don't have to open
+the port (and can't fight over it).
+
+The protocol is a JSON object per line each way:
+
+    {"cmd": "ping"}                       -> {"ok": true, "result": true}
+    {"cmd": "expose", "exptime": 1.0}     -> {"ok": true, "result": {...}}
+    {"cmd": "bogus"}                      -> {"ok": false, "error": "..."}
+
+Commands that need the camera (ping, firmware, heater_on/off, open_shutter,
+close_shutter, shutter_off, chop_on/off, expose) are queued and run by the
+thread that owns the camera, in between exposures, so acquisition never has
+to stop for them.  latest (the last frame's metadata, and its pixels if
+"pixels" is true) and status are answered straight away.
+
+CameraDaemon can be run on its own (python skycamd.py, optionally taking
+frames continuously with --acquire) or inside an acquisition script: start()
+it, then call run_pending() and set_latest() between exposures the way
+skycam.py does.  skycamctl.py is the client.  Given a framepub
+FramePublisher, every frame passed to set_latest() is also pushed out to
+its subscribers.
+"""
+
+import os
+import time
+import json
+import Queue
+import base64
+import socket
+import threading
+import SocketServer
+
+from AllSky340 import AllSky340, cam_log
+from framepub import FramePublisher
+
+SOCKET_PATH = os.environ.get("SKYCAMD_SOCKET", "/tmp/skycamd.sock")
+
+# commands run by the camera thread, and the AllSky340 method for each
+CAMERA_COMMANDS = {"ping": "ping",
+                   "firmware": "firmware",
+                   "heater_on": "heater_on",
+                   "heater_off": "heater_off",
+                   "open_shutter": "open_shutter",
+                   "close_shutter": "close_shutter",
+                   "shutter_off": "shutter_off",
+                   "chop_on": "shutter_chop_on",
+                   "chop_off": "shutter_chop_off"}
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+                reply = {"ok": True,
+                         "result": self.server.camd.submit(request)}
+            except Exception, err:
+                reply = {"ok": False, "error": str(err)}
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class CameraDaemon(object):
+    def __init__(self, cam, path=SOCKET_PATH, timeout=600.0, publisher=None):
+        """
+        cam is an open AllSky340.  requests wait up to timeout seconds for
+        the camera thread to get round to them.  publisher is a started
+        FramePublisher to send frames to, if any.
+        """
+        self.cam = cam
+        self.publisher = publisher
+        self.path = path
+        self.timeout = timeout
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        self.latest = None
+        self.latest_meta = None
+        # cam.report() as of the last thing the camera thread did.  the
+        # socket threads can't call it themselves while the camera thread
+        # is changing the counters underneath them.
+        self.report = None
+        self.server = None
+        self.running = False
+
+    def start(self):
+        """start answering requests on the socket, in a background thread"""
+        self.snapshot()
+        if os.path.exists(self.path):
+            # left over from a daemon that didn't shut down cleanly?
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                probe.close()
+                raise RuntimeError("A camera daemon is already running on %s"
+                                   % self.path)
+            probe.close()
+        self.server = Server(self.path, RequestHandler)
+        self.server.camd = self
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name="skycamd")
+        thread.daemon = True
+        thread.start()
+        self.running = True
+        cam_log.info("Camera daemon listening on %s" % self.path)
+
+    def close(self):
+        self.running = False
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def submit(self, request):
+        """
+        called from the socket threads.  answers what it can from here and
+        queues the rest for the camera thread, waiting for the result.
+        """
+        cmd = request.get("cmd")
+        if cmd == "latest":
+            return self.latest_frame(request.get("pixels", False))
+        if cmd == "status":
+            return self.status()
+        if cmd not in CAMERA_COMMANDS and cmd != "expose":
+            raise ValueError("Unknown command %s" % cmd)
+        reply = Queue.Queue(1)
+        self.requests.put((request, reply))
+        try:
+            ok, result = reply.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise RuntimeError("Timed out waiting for the camera")
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def pending(self):
+        """how many requests are waiting for the camera thread"""
+        return self.requests.qsize()
+
+    def run_pending(self):
+        """
+        run whatever requests have been queued.  call this from the thread
+        that owns the camera whenever it's idle.  returns how many were run.
+        """
+        n = 0
+        while True:
+            try:
+                request, reply = self.requests.get_nowait()
+            except Queue.Empty:
+                return n
+            self.run(request, reply)
+            n += 1
+
+    def snapshot(self):
+        """take a copy of the camera's report, from the camera thread"""
+        report = self.cam.report()
+        with self.lock:
+            self.report = report
+
+    def run(self, request, reply):
+        cmd = request["cmd"]
+        cam_log.info("Running %s for a client" % cmd)
+        try:
+            if cmd == "expose":
+                result = self.expose(request)
+            else:
+                result = getattr(self.cam, CAMERA_COMMANDS[cmd])()
+            self.snapshot()
+            reply.put((True, result))
+        except Exception, err:
+            cam_log.error("%s failed: %s" % (cmd, err))
+            self.snapshot()
+            reply.put((False, str(err)))
+
+    def serve_forever(self, acquire=None, poll=0.5):
+        """
+        be the camera thread: run requests as they come in and, if acquire
+        is an (exptime, light) tuple, take frames continuously in between.
+        """
+        while self.running:
+            if acquire is None:
+                try:
+                    request, reply = self.requests.get(timeout=poll)
+                except Queue.Empty:
+                    continue
+                self.run(request, reply)
+            else:
+                exptime, light = acquire
+                imag, valid = self.cam.getImage(exptime, light=light,
+                                                with_mask=True)
+                self.set_latest(imag, {"exptime": exptime, "light": light,
+                                       "valid": valid})
+                self.run_pending()
+
+    def expose(self, request):
+        """
+        take a frame for a client and make it the latest.  it's read into a
+        frame buffer of its own so it doesn't trample the frames of a
+        sequence() this is run in the middle of.
+        """
+        exptime = float(request.get("exptime", 1.0))
+        light = bool(request.get("light", True))
+        mode = request.get("mode")
+        imag, valid = self.cam.getImage(exptime, light=light, mode=mode,
+                                        with_mask=True, slot="client")
+        meta = self.set_latest(imag, {"exptime": exptime, "light": light,
+                                      "mode": mode, "valid": valid,
+                                      "client": True})
+        return meta
+
+    def set_latest(self, imag, meta):
+        """
+        keep imag as the latest frame.  meta is a dict of whatever goes with
+        it; a per-block valid mask in it is turned into the number of bad
+        blocks.  returns the metadata as it will be handed out.
+        """
+        meta = dict(meta)
+        valid = meta.pop("valid", None)
+        if valid is not None:
+            meta["bad_blocks"] = int(len(valid) - valid.sum())
+        meta.setdefault("time", time.time())
+        meta["shape"] = list(imag.shape)
+        meta["dtype"] = str(imag.dtype)
+        if self.publisher is not None:
+            meta["seq"] = self.publisher.publish(imag, meta)
+        report = self.cam.report()
+        with self.lock:
+            self.report = report
+            self.latest = imag
+            self.latest_meta = meta
+        return meta
+
+    def latest_frame(self, pixels=False):
+        with self.lock:
+            imag, meta = self.latest, self.latest_meta
+        if meta is None:
+            return None
+        meta = dict(meta)
+        if pixels:
+            meta["pixels"] = base64.b64encode(imag.tostring())
+        return meta
+
+    def status(self):
+        with self.lock:
+            report = dict(self.report or {})
+            report["latest"] = self.latest_meta
+        report["queued"] = self.requests.qsize()
+        if self.publisher is not None:
+            report["publisher"] = self.publisher.stats()
+        return report
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option("-p", "--port", default="/dev/ttyUSB0",
+                      help="serial port (default: /dev/ttyUSB0)")
+    parser.add_option("-b", "--baudrate", type=int, default=460800)
+    parser.add_option("-s", "--socket", default=SOCKET_PATH,
+                      help="Unix socket to listen on (default: %s)"
+                      % SOCKET_PATH)
+    parser.add_option("-a", "--acquire", type=float, default=None,
+                      help="take light frames of this exposure time "
+                      "continuously")
+    parser.add_option("-f", "--publish", default=None, metavar="ADDRESS",
+                      help="publish frames on this Unix socket path or "
+                      "host:port")
+    opts, args = parser.parse_args()
+
+    cam = AllSky340(port=opts.port, baudrate=opts.baudrate, timeout=0.1)
+    publisher = None
+    if opts.publish:
+        publisher = FramePublisher(opts.publish)
+        publisher.start()
+    daemon = CameraDaemon(cam, path=opts.socket, publisher=publisher)
+    daemon.start()
+    if opts.acquire is not None:
+        acquire = (opts.acquire, True)
+    else:
+        acquire = None
+    try:
+        daemon.serve_forever(acquire=acquire)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        if publisher is not None:
+            publisher.close()
@@ -1,11 +1,26 @@
 #!/usr/bin/env python
 
+import os
+import sys
 from AllSky340 import AllSky340
 
+# --fake runs against the pty camera simulator instead of the hardware
+if "--fake" in sys.argv:
+    from fakecam import FakeAllSky340
+    fake = FakeAllSky340()
+    port = fake.port
+else:
+    fake = None
+    port = os.environ.get("SKYCAM_PORT", "/dev/ttyUSB1")
+
 #cam = AllSky340(port="/dev/tty.usbserial-A700dzlT", baudrate=460800, timeout=1)
-cam = AllSky340(port="/dev/ttyUSB1", baudrate=460800, timeout=1)
-cam.log_info("Testing camera communication.")
+try:
+    cam = AllSky340(port=port, baudrate=460800, timeout=1)
+    cam.log_info("Testing camera communication.")
 
-p = cam.ping()
-if p:
-    cam.firmware()
+    p = cam.ping()
+    if p:
+        cam.firmware()
+finally:
+    if fake is not None:
+        fake.close()